@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Copyright 2023 ARC Centre of Excellence for Climate Extremes
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+asyncio versions of the ESGF search functions
+
+The coroutines run the same engine as :mod:`clef.esgf`, sharing its pooled
+HTTP session and response cache, so many searches can run concurrently from a
+notebook::
+
+    import asyncio
+    from clef import aio
+
+    results = await asyncio.gather(*[
+        aio.esgf_query(project='CMIP6', source_id=m, variable_id='tas', limit=0)
+        for m in models])
+
+The number of searches running at the same time is limited by
+:data:`max_concurrency`.
+"""
+
+import asyncio
+import functools
+import weakref
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import esgf
+
+
+#: Maximum number of ESGF searches running at the same time
+max_concurrency = 8
+
+#: Maximum number of pages each search downloads at the same time, the
+#: `workers` of :func:`clef.esgf.esgf_docs`
+search_workers = 4
+
+_executor = None
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max_concurrency,
+                                       thread_name_prefix='clef-aio')
+    return _executor
+
+
+def _get_semaphore():
+    # semaphores belong to an event loop, keep one for each loop
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(max_concurrency)
+    return _semaphores[loop]
+
+
+def configure_aio(concurrency):
+    """Change the maximum number of ESGF searches running at the same time
+
+    The HTTP connection pool of :mod:`clef.esgf` is enlarged if needed, so it
+    can keep a connection for each page request of the concurrent searches.
+
+    Args:
+        concurrency (int): maximum number of concurrent searches
+    """
+    global max_concurrency, _executor
+    max_concurrency = concurrency
+    if esgf.http_config['pool_size'] < concurrency * search_workers:
+        esgf.configure_esgf(pool_size=concurrency * search_workers)
+    _semaphores.clear()
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+async def _run(func, *args, **kwargs):
+    """Run a blocking search function in the shared executor"""
+    async with _get_semaphore():
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_executor(),
+                                          functools.partial(func, *args, **kwargs))
+
+
+async def esgf_query(*args, **kwargs):
+    """Search the ESGF
+
+    See :func:`clef.esgf.esgf_query`
+    """
+    return await _run(esgf.esgf_query, *args, **kwargs)
+
+
+async def esgf_docs(*args, **kwargs):
+    """Return all the documents matching an ESGF search as a list
+
+    See :func:`clef.esgf.esgf_docs`
+    """
+    return await _run(lambda: list(esgf.esgf_docs(*args, **kwargs)))
+
+
+async def find_checksum_id_async(query, **kwargs):
+    """Get checksums and IDs of matching files from ESGF
+
+    See :func:`clef.esgf.find_checksum_id`
+    """
+    return await _run(esgf.find_checksum_id, query, **kwargs)
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# Copyright 2023 ARC Centre of Excellence for Climate Extremes
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Persistent cache of query results
+
+* :class:`DiskCache` stores values in a SQLite file, with an expiry time and
+  a maximum total size after which the least recently used entries are
+  removed.
+* :func:`canonical_key` converts query parameters into a cache key that does
+  not depend on the order of the arguments or values.
+* :func:`get_cache` returns the cache shared by all the ESGF queries, which
+  can be changed with :func:`configure_cache`.
+* :class:`MemoryCache` keeps the most recently used values in memory.
+* :func:`get_local_cache` returns the caches of the local query results,
+  which can be changed with :func:`configure_local_cache`.
+
+By default the caches are stored in ``$XDG_CACHE_HOME/clef`` (``~/.cache/clef``
+if the variable is not set).
+"""
+
+import os
+import time
+import json
+import hashlib
+import logging
+import sqlite3
+import zlib
+
+from collections import OrderedDict
+
+
+#: Settings of the ESGF responses cache, ttl is the default expiry time in seconds
+#: and max_size the maximum size of the cache file in bytes
+cache_config = {
+        'enabled': True,
+        'refresh': False,
+        'ttl': 3600,
+        'max_size': 64 * 1024**2,
+        'path': None,
+        }
+
+#: Settings of the local query results cache, max_entries is the number of
+#: results kept in memory, with disk the results are also stored in a SQLite
+#: file of at most max_size bytes
+local_cache_config = {
+        'enabled': True,
+        'refresh': False,
+        'max_entries': 32,
+        'disk': False,
+        'max_size': 64 * 1024**2,
+        'path': None,
+        }
+
+
+def cache_dir():
+    """Return the directory used to store the clef caches
+    """
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'clef')
+
+
+def canonical_key(params):
+    """Convert query parameters to a cache key
+
+    Empty constraints are dropped, and multiple values are sorted so that
+    lists and tuples with the same values return the same key. A single value
+    returns the same key as a list with only that value
+
+    >>> canonical_key({'variable': ('tas', 'pr'), 'model': ()}) == canonical_key({'variable': ['pr', 'tas']})
+    True
+    >>> canonical_key({'variable': 'tas'}) == canonical_key({'variable': ['tas']})
+    True
+
+    Args:
+        params (dict): query parameters
+
+    Returns:
+        str: hash of the normalised parameters
+    """
+    norm = {}
+    for k, v in params.items():
+        if v is None or (isinstance(v, (list, tuple, set, str)) and len(v) == 0):
+            continue
+        if isinstance(v, (list, tuple, set)):
+            v = sorted(str(x) for x in v)
+            if len(v) == 1:
+                v = v[0]
+        else:
+            v = str(v)
+        norm[k] = v
+    text = json.dumps(norm, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class DiskCache:
+    """Key-value cache stored in a SQLite file
+
+    Values are compressed bytes. A new connection is opened for each
+    operation, so the cache can be used from multiple threads and processes.
+    Errors reading or writing the file, e.g. a locked database, a full disk or
+    a corrupt entry, are logged once and treated as a missing value.
+
+    Args:
+        path (str): SQLite file
+        max_size (int): Maximum total size of the stored values in bytes
+    """
+
+    def __init__(self, path, max_size=cache_config['max_size']):
+        self.path = path
+        self.max_size = max_size
+        self._warned = False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                         'key TEXT PRIMARY KEY, created REAL, accessed REAL, '
+                         'size INTEGER, value BLOB)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _error(self, e):
+        if not self._warned:
+            logging.getLogger(__name__).warning(f'Cache {self.path} not available: {e}')
+            self._warned = True
+
+    def get(self, key, ttl=None):
+        """Return the value stored for key, or None if missing or older than ttl seconds
+        """
+        now = time.time()
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    row = conn.execute('SELECT created, value FROM cache WHERE key = ?', (key,)).fetchone()
+                    if row is None:
+                        return None
+                    if ttl is not None and now - row[0] > ttl:
+                        conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+                        return None
+                    conn.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+            finally:
+                conn.close()
+            return zlib.decompress(row[1])
+        except (sqlite3.Error, OSError, zlib.error) as e:
+            self._error(e)
+            return None
+
+    def put(self, key, value):
+        """Store value (bytes) for key, removing the least recently used
+        entries if the cache is larger than max_size
+        """
+        data = zlib.compress(value)
+        if len(data) > self.max_size:
+            return
+        now = time.time()
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                                 (key, now, now, len(data), data))
+                    total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+                    if total > self.max_size:
+                        rows = conn.execute('SELECT key, size FROM cache ORDER BY accessed').fetchall()
+                        for k, size in rows:
+                            if total <= self.max_size:
+                                break
+                            conn.execute('DELETE FROM cache WHERE key = ?', (k,))
+                            total -= size
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError) as e:
+            self._error(e)
+
+    def clear(self):
+        """Remove all entries
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM cache')
+        finally:
+            conn.close()
+
+
+class MemoryCache:
+    """Key-value cache kept in memory
+
+    Values can be any object. When there are more than max_entries values the
+    least recently used ones are removed.
+
+    Args:
+        max_entries (int): Maximum number of stored values
+    """
+
+    def __init__(self, max_entries=local_cache_config['max_entries']):
+        self.max_entries = max_entries
+        self._values = OrderedDict()
+
+    def get(self, key):
+        """Return the value stored for key, or None if missing
+        """
+        if key not in self._values:
+            return None
+        self._values.move_to_end(key)
+        return self._values[key]
+
+    def put(self, key, value):
+        """Store value for key, removing the least recently used entries if
+        there are more than max_entries
+        """
+        self._values[key] = value
+        self._values.move_to_end(key)
+        while len(self._values) > self.max_entries:
+            self._values.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries
+        """
+        self._values.clear()
+
+
+_cache = None
+_local_cache = MemoryCache()
+_local_disk_cache = None
+
+
+def get_cache():
+    """Return the ESGF responses cache, or None if caching is disabled
+    """
+    global _cache
+    if not cache_config['enabled']:
+        return None
+    path = cache_config['path'] or os.path.join(cache_dir(), 'esgf.sqlite')
+    if _cache is None or _cache.path != path:
+        try:
+            _cache = DiskCache(path, cache_config['max_size'])
+        except (OSError, sqlite3.Error):
+            # e.g. read-only home directory, carry on without cache
+            return None
+    _cache.max_size = cache_config['max_size']
+    return _cache
+
+
+def configure_cache(enabled=None, refresh=None, ttl=None, max_size=None, path=None):
+    """Change the ESGF responses cache settings
+
+    Args:
+        enabled (bool): Use the cache
+        refresh (bool): Ignore stored responses, but still store the new ones
+        ttl (int): Default expiry time of the stored responses in seconds
+        max_size (int): Maximum size of the cache in bytes
+        path (str): SQLite file used to store the cache
+    """
+    for k, v in [('enabled', enabled), ('refresh', refresh), ('ttl', ttl),
+                 ('max_size', max_size), ('path', path)]:
+        if v is not None:
+            cache_config[k] = v
+
+
+def get_local_cache():
+    """Return the memory and disk caches of the local query results
+
+    Returns:
+        tuple (memory, disk), None if the cache is disabled
+    """
+    global _local_disk_cache
+    if not local_cache_config['enabled']:
+        return None, None
+    _local_cache.max_entries = local_cache_config['max_entries']
+    if not local_cache_config['disk']:
+        return _local_cache, None
+    path = local_cache_config['path'] or os.path.join(cache_dir(), 'local.sqlite')
+    if _local_disk_cache is None or _local_disk_cache.path != path:
+        try:
+            _local_disk_cache = DiskCache(path, local_cache_config['max_size'])
+        except (OSError, sqlite3.Error):
+            return _local_cache, None
+    _local_disk_cache.max_size = local_cache_config['max_size']
+    return _local_cache, _local_disk_cache
+
+
+def configure_local_cache(enabled=None, refresh=None, max_entries=None, disk=None,
+                          max_size=None, path=None):
+    """Change the local query results cache settings
+
+    Args:
+        enabled (bool): Use the cache
+        refresh (bool): Ignore stored results, but still store the new ones
+        max_entries (int): Maximum number of results kept in memory
+        disk (bool): Also store the results in a SQLite file
+        max_size (int): Maximum size of the SQLite file in bytes
+        path (str): SQLite file used to store the results
+    """
+    for k, v in [('enabled', enabled), ('refresh', refresh), ('max_entries', max_entries),
+                 ('disk', disk), ('max_size', max_size), ('path', path)]:
+        if v is not None:
+            local_cache_config[k] = v
+    if enabled is False:
+        _local_cache.clear()
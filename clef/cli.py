@@ -20,17 +20,18 @@ import logging
 import sys
 import os
 import stat
-from itertools import repeat
 from datetime import datetime
 
 from .db import connect, Session
-from .esgf import match_query, find_local_path, find_missing_id, find_checksum_id
+from .esgf import match_query, find_local_missing, stream_local_missing, find_checksum_id, match_datasets, dataset_facets
 from .download import write_request, search_queue_csv 
 from . import collections as colls
 from .exception import ClefException
-from .code import call_local_query, matching, write_csv, print_stats, ids_df
-from .helpers import load_vocabularies, fix_model, fix_path, get_ids
+from .code import call_local_query, stream_local_paths, local_query_chunks, matching, write_csv, \
+                   write_csv_chunks, print_stats, ids_df
+from .helpers import VocabChoice, fix_model, fix_path, fix_dirs, get_ids
 from .esdoc import citation, write_cite
+from .cache import configure_cache, configure_local_cache
 import clef.cordex as cordex_
 
 
@@ -59,18 +60,28 @@ def clef_catch():
                help="send NCI request to download missing files matching ESGF search")
 @click.option('--debug', is_flag=True, default=False,
                help="Show debug info")
+@click.option('--no-cache', 'no_cache', is_flag=True, default=False,
+               help="Don't use the cache of recent ESGF and local query results, kept in "
+                    "~/.cache/clef in two files of at most 64 MB each")
+@click.option('--refresh-cache', 'refresh_cache', is_flag=True, default=False,
+               help="Query ESGF and the local database again and update the cached results")
+@click.option('--stream', is_flag=True, default=False,
+               help="Print paths as soon as the database returns them, instead of sorted at the end")
 @click.pass_context
-def clef(ctx, flow, debug):
+def clef(ctx, flow, debug, no_cache, refresh_cache, stream):
     ctx.obj={}
     # set up a default value for flow if none selected for logging
     if flow is None: flow = 'default'
     ctx.obj['flow'] = flow
+    ctx.obj['stream'] = stream
     ctx.obj['log'] = config_log()
 
     if debug:
         debug_logger = logging.getLogger('clef_debug')
         debug_logger.setLevel(logging.DEBUG)
-    
+    configure_cache(enabled=not no_cache, refresh=refresh_cache)
+    configure_local_cache(enabled=not no_cache, refresh=refresh_cache, disk=True)
+
 
 def config_log():
     ''' configure log file to keep track of users queries '''
@@ -108,25 +119,42 @@ def warning(message):
     print("WARNING: %s"%message, file=sys.stderr)
 
 
+def print_unique(values, seen):
+    """Print values as soon as they are generated, skipping the ones in seen
+    """
+    for v in values:
+        if v not in seen:
+            seen.add(v)
+            print(v, flush=True)
+
+
+def print_paths(chunks):
+    """Print the paths of chunks of local query results as they are read
+    """
+    for df in chunks:
+        for p in df['path']:
+            print(p, flush=True)
+        yield df
+
+
 def cmip5_args(f):
     """Define CMIP5 only click arguments
     """
-    vocab = load_vocabularies('CMIP5')
     constraints = [
-        click.option('--experiment', '-e', multiple=True, type=click.Choice(vocab['experiment']), metavar='x',
+        click.option('--experiment', '-e', multiple=True, type=VocabChoice('CMIP5', 'experiment'), metavar='x',
                       help="CMIP5 experiment: piControl, rcp85, amip ..."),
-        click.option('--experiment_family',multiple=False, type=click.Choice(vocab['experiment_family']),
+        click.option('--experiment_family',multiple=False, type=VocabChoice('CMIP5', 'experiment_family'),
                       help="CMIP5 experiment family: Decadal, RCP ..."),
-        click.option('--model', '-m', multiple=True, type=click.Choice(vocab['model']),  metavar='x',
+        click.option('--model', '-m', multiple=True, type=VocabChoice('CMIP5', 'model'),  metavar='x',
                       help="CMIP5 model acronym: ACCESS1.3, MIROC5 ..."),
-        click.option('--table', '--mip', '-t', 'cmor_table', multiple=True, type=click.Choice(vocab['cmor_table']) ),
-        click.option('--variable', '-v', multiple=True, type=click.Choice(vocab['variable']), metavar='x',
+        click.option('--table', '--mip', '-t', 'cmor_table', multiple=True, type=VocabChoice('CMIP5', 'cmor_table') ),
+        click.option('--variable', '-v', multiple=True, type=VocabChoice('CMIP5', 'variable'), metavar='x',
                       help="Variable name as shown in filanames: tas, pr, sic ... "),
         click.option('--ensemble', '--member', '-en', 'ensemble', multiple=True, help="CMIP5 ensemble member: r#i#p#"),
-        click.option('--frequency', 'time_frequency', multiple=True, type=click.Choice(vocab['time_frequency']) ),
-        click.option('--realm', multiple=True, type=click.Choice(vocab['realm']) ),
+        click.option('--frequency', 'time_frequency', multiple=True, type=VocabChoice('CMIP5', 'time_frequency') ),
+        click.option('--realm', multiple=True, type=VocabChoice('CMIP5', 'realm') ),
         click.option('--cf_standard_name',multiple=True, help="CF variable standard_name, use instead of variable constraint "),
-        click.option('--and', 'and_attr', multiple=True, type=click.Choice(vocab['attributes']),
+        click.option('--and', 'and_attr', multiple=True, type=VocabChoice('CMIP5', 'attributes'),
                       help=("Attributes for which we want to add AND filter, i.e. `--and variable` to apply to variable values")),
         click.option('--institution', 'institute', multiple=True, help="Modelling group institution id: MIROC, IPSL, MRI ...")
     ]
@@ -161,30 +189,29 @@ def common_args(f):
 def cmip6_args(f):
     """Define CMIP6 only click arguments
     """
-    vocab = load_vocabularies('CMIP6')
     constraints = [
-        click.option('--activity', '-mip', 'activity_id', multiple=True, type=click.Choice(vocab['activity_id']) ) ,
-        click.option('--experiment', '-e', 'experiment_id', multiple=True, type=click.Choice(vocab['experiment_id']),
+        click.option('--activity', '-mip', 'activity_id', multiple=True, type=VocabChoice('CMIP6', 'activity_id') ) ,
+        click.option('--experiment', '-e', 'experiment_id', multiple=True, type=VocabChoice('CMIP6', 'experiment_id'),
                      metavar='x', help="CMIP6 experiment, list of available depends on activity"),
-        click.option('--source_type',multiple=True, type=click.Choice(vocab['source_type']) ),
-        click.option('--table', '-t', 'table_id', multiple=True, type=click.Choice(vocab['table_id']), metavar='x',
+        click.option('--source_type',multiple=True, type=VocabChoice('CMIP6', 'source_type') ),
+        click.option('--table', '-t', 'table_id', multiple=True, type=VocabChoice('CMIP6', 'table_id'), metavar='x',
                      help="CMIP6 CMOR table: Amon, SIday, Oday ..."),
-        click.option('--model', '--source_id','-m', 'source_id', multiple=True, type=click.Choice(vocab['source_id']),
+        click.option('--model', '--source_id','-m', 'source_id', multiple=True, type=VocabChoice('CMIP6', 'source_id'),
                      metavar='x', help="CMIP6 model id: GFDL-AM4, CNRM-CM6-1 ..."),
-        click.option('--variable', 'variable_id', '-v', multiple=True, type=click.Choice(vocab['variable_id']),
+        click.option('--variable', 'variable_id', '-v', multiple=True, type=VocabChoice('CMIP6', 'variable_id'),
                      metavar='x', help="CMIP6 variable name as in filenames"),
         click.option('--member', '-mi', 'member_id', multiple=True, help="CMIP6 member id: <sub-exp-id>-r#i#p#f#"),
         click.option('--grid', '--grid_label', '-g', 'grid_label', multiple=True,
                      help="CMIP6 grid label: i.e. gn for the model native grid"),
         click.option('--resolution', '--nominal_resolution','-nr' , 'nominal_resolution', multiple=True,
                      help="Approximate resolution: '250 km', pass in quotes"),
-        click.option('--frequency',multiple=True, type=click.Choice(vocab['frequency']) ),
-        click.option('--realm', multiple=True, type=click.Choice(vocab['realm']) ),
+        click.option('--frequency',multiple=True, type=VocabChoice('CMIP6', 'frequency') ),
+        click.option('--realm', multiple=True, type=VocabChoice('CMIP6', 'realm') ),
         click.option('--sub_experiment_id', '-se', multiple=True,
                      help="Only available for hindcast and forecast experiments: sYYYY"),
         click.option('--variant_label', '-vl', multiple=True, help="Indicates a model variant: r#i#p#f#"),
         click.option('--cf_standard_name',multiple=True, help="CF variable standard_name, use instead of variable constraint "),
-        click.option('--and', 'and_attr', multiple=True, type=click.Choice(vocab['attributes']),
+        click.option('--and', 'and_attr', multiple=True, type=VocabChoice('CMIP6', 'attributes'),
                       help=("Attributes for which we want to add AND filter, i.e. `--and variable_id` to apply to variable values")),
         click.option('--cite', 'cite', is_flag=True, default=False,
                      help="Write list of citations for query results, works only with --remote and --local options. Default: False"),
@@ -334,6 +361,7 @@ def common_esgf_cli(ctx, project, query, latest, replica, distrib,
         logging.getLogger('clex_debug').setLevel(level=logging.INFO)
 
     clef_log = ctx.obj['log']
+    stream = ctx.obj.get('stream', False)
     user_name=os.environ.get('USER','unknown')
     user=None
     connect(user=user)
@@ -377,8 +405,13 @@ def common_esgf_cli(ctx, project, query, latest, replica, distrib,
                 latest=latest,
                 project=project,
                 limit=10000,
+                split=True,
                 **constraints,
                 )
+            if stream and not (stats or csvf or cite):
+                print_unique((x.dataset_id for x in s.query(q.c.dataset_id)
+                    .order_by(q.c.dataset_id).yield_per(1000)), set())
+                return
             val = [x for x in s.query(q)][0]
 
             ids=sorted(set(x.dataset_id for x in s.query(q)))
@@ -408,6 +441,13 @@ def common_esgf_cli(ctx, project, query, latest, replica, distrib,
                 if project == 'CORDEX':
                     line += f" rcm versions: {', '.join(row.rcm_version)}"
                 print(line)
+        elif stream and not (stats or csvf or cite):
+            print_unique(stream_local_paths(s, project, latest, **terms), set())
+            return
+        elif stream and not (stats or cite):
+            # write the csv file as the datasets are read
+            write_csv_chunks(print_paths(local_query_chunks(s, project, latest, **terms)))
+            return
         else:
             results, paths = call_local_query(s, project, latest, **terms)
             if not stats:
@@ -424,30 +464,59 @@ def common_esgf_cli(ctx, project, query, latest, replica, distrib,
         return
 
     # if not local, query ESGF first and then DB based on checksums
-    subq = match_query(s, query=' '.join(query),
-            distrib=distrib,
-            replica=replica,
-            latest=(latest if latest else None),
-            project=project,
-            **terms
-            )
-
-    # Make sure that if find_local_path does an all-version search using the
-    # filename, the resulting project is still CMIP6 (and not say a PMIP file
-    # with the same name)
-    ql = find_local_path(s, subq)
-
-    if not ctx.obj['flow'] == 'missing':
+    # for the latest versions whole datasets are compared first, and only the
+    # ones that are not complete locally are matched file by file
+    show = not ctx.obj['flow'] == 'missing'
+    seen = set()
+    paths = []
+    pending = None
+    if latest and project in dataset_facets:
+        paths, pending = match_datasets(s, ' '.join(query),
+                project,
+                distrib=distrib,
+                replica=replica,
+                latest=True,
+                **terms
+                )
+        if stream and show:
+            print_unique(fix_dirs(paths, latest), seen)
+
+    qm = []
+    if pending is None or len(pending) > 0:
+        subq = match_query(s, query=' '.join(query),
+                distrib=distrib,
+                replica=replica,
+                latest=(latest if latest else None),
+                project=project,
+                split=True,
+                datasets=pending,
+                **terms
+                )
+
+        # Make sure that if find_local_missing does an all-version search using the
+        # filename, the resulting project is still CMIP6 (and not say a PMIP file
+        # with the same name)
+        if stream:
+            missing = {}
+            for is_local, value in stream_local_missing(s, subq):
+                if not is_local:
+                    missing[(value,)] = None
+                elif show:
+                    print_unique([fix_path(value, latest)], seen)
+            qm = list(missing)
+        else:
+            local, qm = find_local_missing(s, subq)
+            paths += local
+
+    if show and not stream:
         # temporary fix to return only one combined path instead of 1 or 2 output ones
-        cpaths = sorted(set(map(fix_path, [p[0] for p in ql], repeat(latest))))
+        cpaths = sorted(set(fix_dirs(paths, latest)))
         for p in cpaths:
             print(p)
 
-    qm = find_missing_id(s, subq)
-
     # if there are missing datasets, search for dataset_id in synda queue,
     #  update list and print result
-    if qm.count() > 0:
+    if len(qm) > 0:
         varlist = []
         if project in ['CMIP5'] and 'variable' in terms:
             varlist = terms['variable']
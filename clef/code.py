@@ -16,23 +16,60 @@
 
 import sys
 import os
+import numpy as np
 import pandas as pd
 import json
 import re
+import pickle
 import pkg_resources
 import itertools
 
-from sqlalchemy import any_
+import sqlalchemy as sa
+from sqlalchemy import any_, bindparam, func
+from sqlalchemy.dialects.postgresql import ARRAY
 
 from .db import connect, Session
 from .model import Path, C5Dataset, C6Dataset, ExtendedMetadata, CordexDataset
 from .exception import ClefException
-from .esgf import esgf_query
-from .helpers import convert_periods, time_axis, check_values, check_keys, fix_model, fix_path, \
-                     get_facets, get_range, get_version, get_keys, load_vocabularies, get_member
+from .esgf import esgf_docs
+from .cache import get_local_cache, local_cache_config, canonical_key
+from .drs import parse_ids
+from .vocab import value_sets
+from .helpers import period_stats, check_values, check_keys, fix_model, fix_dirs, fix_path_sql, \
+                     get_facets, get_version, version_key_sql, get_keys, load_vocabularies, \
+                     get_member
 
 
-def search(session, project='CMIP5', latest=True, **kwargs):
+#: Results with at least this many rows are returned as compact frames by
+#: default, see :func:`compact_frame`
+compact_rows = 10000
+
+#: Columns with a different value for most rows, never converted to categories
+unique_columns = ['path', 'dataset_id', 'fdate', 'tdate', 'time_complete']
+
+#: Dataset table and relationship to the files of each project
+dataset_tables = {'CMIP5': [C5Dataset, Path.c5dataset],
+                  'CMIP6': [C6Dataset, Path.c6dataset],
+                  'CORDEX': [CordexDataset, Path.cordexdataset]}
+
+#: Array columns of the dataset tables, used to filter the experiment family and
+#: activity constraints but not returned in the results
+filter_columns = ['experiment_family', 'activity_ids']
+
+#: Queries built by :func:`template_query` and their aggregated statements,
+#: keyed by the constraints shape
+_query_cache = {}
+_statement_cache = {}
+
+#: Table updated by db/refresh.sql after refreshing the materialized views, a
+#: new refresh_id invalidates the cached local query results
+refresh_table = 'clef_refresh'
+
+# if refresh_table can be read, by database url
+_refresh_tables = {}
+
+
+def search(session, project='CMIP5', latest=True, compact=None, all_of=None, **kwargs):
     """Call local query interactively.
 
     Can be used when in python script, first checks that the arguments names
@@ -43,7 +80,10 @@ def search(session, project='CMIP5', latest=True, **kwargs):
         session (SQLAlchemy obj): the db session
         project (str): data project (default CMIP5)
         latest (bool): version latest (default True) or all (False)
-        kwargs (dict): query constraints
+        compact (bool): return a compact frame, see :func:`compact_frame`
+        all_of (tuple): lists of attributes (cols, fixed), return only the
+            simulations that have all the values of cols, see :func:`matching`
+        kwargs (dict): query constraints, a list of values matches any of them
 
     Returns:
         results (pandas.DataFrame): each row describes one simulation matching the constraints
@@ -56,18 +96,16 @@ def search(session, project='CMIP5', latest=True, **kwargs):
     valid_keys = get_keys(project)
     # check all passed keys are valid
     args = check_keys(valid_keys, kwargs)
-    # load dictionary of valid keys for project facets
-    vocabularies = load_vocabularies(project)
-    check_values(args, project, vocabularies)
+    # check values against the sets of accepted values for project facets
+    check_values(args, project, value_sets(project))
     if 'model' in args.keys():
-        args['model'] = fix_model(project, [args['model']])[0]
-    results = local_query(session, project, latest, **args)
-    if latest:
-        results = local_latest(results)
+        args['model'] = fix_model(project, as_list(args['model']))
+    results = local_query(session, project, latest, filter_latest=latest, compact=compact,
+                          all_of=all_of, **args)
     return results
 
 
-def matching(session, cols, fixed, project='CMIP5', local=True, latest=True, **kwargs):
+def matching(session, cols, fixed, project='CMIP5', local=True, latest=True, compact=None, **kwargs):
     """Call and_filter after executing local or remote query of passed constraints
       
     This function is called by the command line with the 'and' argument.
@@ -80,6 +118,7 @@ def matching(session, cols, fixed, project='CMIP5', local=True, latest=True, **k
         project (string): project, i.e. CMIP5 (default)/CMIP6
         local (boolean): default local query (True) or remote query (False)
         latest (boolean): default True returns only latest version
+        compact (boolean): filter compact frames, see :func:`compact_frame`
         kwargs (dictionary): query constraints
 
     Returns:
@@ -92,12 +131,9 @@ def matching(session, cols, fixed, project='CMIP5', local=True, latest=True, **k
         # use local search
         if local:
             msg = "There are no simulations stored locally"
-            # perform the query for each variable separately and concatenate the results
-            combs = [dict(zip(kwargs, x)) for x in itertools.product(*kwargs.values())]
-            for c in combs:
-                res_list.append(search(session,project=project.upper(),
-                                            latest=latest, **c))
-            results = pd.concat(res_list, ignore_index=True)
+            # a single query returns only the simulations with all the values passed
+            results = search(session, project=project.upper(), latest=latest,
+                             compact=compact, all_of=(cols, fixed), **kwargs)
         # use ESGF search
         else:
             msg = "There are no simulations currently available on the ESGF nodes"
@@ -106,13 +142,13 @@ def matching(session, cols, fixed, project='CMIP5', local=True, latest=True, **k
             attrs = ['dataset_id', 'version'] # datetime_start, datetime_stop
             attrs.extend( load_vocabularies(project)['attributes'])
             query=None
-            response = esgf_query(query, ','.join(attrs), latest=latest, **kwquery)
+            docs = esgf_docs(query, ','.join(attrs), latest=latest, **kwquery)
             # can't create dataframe in one go because many values are unidimensional lists
             res_list = []
-            for row in response['response']['docs']:
+            for row in docs:
                 row['version'] = row['dataset_id'].split("|")[0].split(".")[-1],
                 res_list.append({k:(v[0] if isinstance(v,list) else v) for k,v in row.items()})
-            results = pd.DataFrame(res_list)
+            results = compact_frame(pd.DataFrame(res_list), compact)
 
     except Exception as e:
         print('ERROR',str(e))
@@ -129,13 +165,13 @@ def matching(session, cols, fixed, project='CMIP5', local=True, latest=True, **k
 
 
 def call_local_query(s, project, latest, **kwargs):
-    """Call local_query for each combination of constraints passed as argument
+    """Call local_query for all the constraints passed as argument
 
     Args:
         s (SQLAlchemy session obj): database session
         project (string): project, i.e. CMIP5/CMIP6
         latest (boolean): True returns only latest version
-        kwargs (dictionary): query constraints
+        kwargs (dictionary): query constraints, each can have multiple values
 
     Returns:
         datasets (pandas.DataFrame): the full query results
@@ -143,117 +179,506 @@ def call_local_query(s, project, latest, **kwargs):
 
     """
 
-    ds_list = [] 
-    paths = []
-    combs = [dict(zip(kwargs, x)) for x in itertools.product(*kwargs.values())]
-    for c in combs:
-         ds_list.append(local_query(s,project=project, latest=latest, **c))
-    datasets = pd.concat(ds_list, ignore_index=True)
-    
+    datasets = local_query(s, project=project, latest=latest, **kwargs)
     paths = datasets['path'].tolist()
     return datasets, paths
 
 
-def local_query(session, project='CMIP5', latest=True, **kwargs):
+def stream_local_paths(s, project, latest, batch=1000, **kwargs):
+    """Generator version of :func:`call_local_query` returning only the paths
+
+    The files are read with a server-side cursor ordered by path, so each
+    directory is returned as soon as it is found instead of after the whole
+    query has run. The directories are fixed in the database by
+    :func:`clef.helpers.fix_path_sql`, a directory can be returned more than
+    once if different paths are fixed to the same one.
+
+    Args:
+        s (SQLAlchemy session obj): database session
+        project (string): project, i.e. CMIP5/CMIP6
+        latest (boolean): True returns only latest version
+        batch (int): number of rows fetched at a time
+        kwargs (dictionary): query constraints
+
+    Returns:
+        paths (generator): directory paths
+    """
+
+    directory = func.regexp_replace(Path.path, '/[^/]*$', '/')
+    q = (build_query(s, project.upper(), **kwargs)
+            .with_entities(fix_path_sql(directory, latest))
+            .order_by(Path.path)
+            .yield_per(batch))
+    last = None
+    for (path,) in q:
+        p = os.path.dirname(path)
+        # added to eliminate wrong paths for mk3.6.0 once that is fixed might be removed
+        if p != last and p != '/path/todelete':
+            yield p
+        last = p
+
+
+def local_query(session, project='CMIP5', latest=True, filter_latest=False, compact=None,
+                all_of=None, **kwargs):
     """Query DB matching directly the constraints to the file attributes instead of querying first the ESGF
 
     Args:
         session (SQLAlchemy session obj): database session
         project (string): project, i.e. CMIP5 (default)/CMIP6
         latest (boolean): True (default) returns only latest version
+        filter_latest (boolean): select the latest version of each dataset in the
+            database, see :func:`latest_query`
+        compact (boolean): return a compact frame, see :func:`compact_frame`
+        all_of (tuple): lists of attributes (cols, fixed), return only the
+            simulations that have all the values of cols, see :func:`all_of_query`
         kwargs (dictionary): query constraints
 
     Returns:
       results (pandas.DataFrame): each row describe one simulation matching the constraints
 
+    The results are cached until the database is refreshed, see :func:`refresh_token`
+    and :func:`clef.cache.configure_local_cache`
     """ 
 
     # make sure project is upper case 
     project = project.upper()
-    r = build_query(session, project, **kwargs)
 
-    # run the sql using pandas read_sql,index data using path, returns a dataframe
-    df = pd.read_sql(r.selectable, con=session.connection())
-    df = df.rename(columns={'path': 'opath'})
+    # look for the results of an identical query since the last refresh
+    memory, disk = get_local_cache()
+    key = None
+    if memory is not None:
+        token = refresh_token(session)
+        if token is not None:
+            key = canonical_key({'project': project, 'latest': latest, 'filter_latest': filter_latest,
+                                 'compact': compact, 'all_of': all_of, 'refresh_token': token,
+                                 **{k: as_list(v) for k, v in kwargs.items()}})
+    if key is not None and not local_cache_config['refresh']:
+        res = memory.get(key)
+        if res is None and disk is not None:
+            data = disk.get(key)
+            if data is not None:
+                try:
+                    res = pickle.loads(data)
+                    memory.put(key, res)
+                except (pickle.UnpicklingError, EOFError, AttributeError, ImportError,
+                        IndexError, TypeError, ValueError):
+                    # truncated, or written by another pandas version, the
+                    # query runs again and the entry is replaced
+                    res = None
+        if res is not None:
+            return res.copy()
+
+    # run the sql aggregated by directory using pandas read_sql, returns a dataframe
+    sql, params = local_statement(project, filter_latest, all_of=all_of, **kwargs)
+    df = pd.read_sql(sql, con=session.connection(), params=params)
+    res = compact_frame(group_datasets(fix_directories(df, latest), filter_latest), compact)
+
+    if key is not None:
+        memory.put(key, res)
+        if disk is not None:
+            disk.put(key, pickle.dumps(res))
+        res = res.copy()
+    return res
+
+
+def refresh_token(session):
+    """Return a value that changes each time the database is refreshed
+
+    db/refresh.sql increments refresh_id in :data:`refresh_table` once all
+    the views are refreshed, reading it is a lookup of a single row. Whether
+    the table can be read is checked once for each database, a database
+    without it is never queried again and its results are not cached.
 
-    # fix path by substituing output1/2 with combined, separate path from filenames
-    fix_paths = df['opath'].apply(fix_path, latest=latest)
-    df['path'] = fix_paths.map(os.path.dirname)
+    Args:
+        session (SQLAlchemy session obj): database session
+
+    Returns:
+        token (str): the refresh id and time, None if the table is not available
+    """
+    url = str(session.get_bind().url)
+    if url not in _refresh_tables:
+        # to_regclass returns NULL instead of failing, so the caller's
+        # transaction is never aborted
+        check = sa.text('SELECT CASE WHEN to_regclass(:name) IS NULL THEN false '
+                        "ELSE has_table_privilege(to_regclass(:name), 'SELECT') END")
+        _refresh_tables[url] = bool(session.execute(check, {'name': refresh_table}).scalar())
+    if not _refresh_tables[url]:
+        return None
+    row = session.execute(sa.text(f'SELECT refresh_id, refreshed FROM {refresh_table}')).first()
+    if row is None:
+        return None
+    return json.dumps(tuple(row), default=str)
+
+
+def local_query_chunks(session, project='CMIP5', latest=True, chunksize=10000,
+                       filter_latest=False, compact=None, **kwargs):
+    """Generator version of :func:`local_query` reading the results in chunks
+
+    The directories are read with a server-side cursor, ordered by their fixed
+    path so that the directories combined in one dataset are read together.
+    Each chunk returns the datasets completed so far, so the memory used
+    depends on the chunk size instead of the number of results.
+
+    The :func:`local_latest` fallback for datasets without a version only
+    compares the datasets in the same chunk.
+
+    Args:
+        session (SQLAlchemy session obj): database session
+        project (string): project, i.e. CMIP5 (default)/CMIP6
+        latest (boolean): True (default) returns only latest version
+        chunksize (int): number of directories read at a time
+        filter_latest (boolean): select the latest version of each dataset in the
+            database, see :func:`latest_query`
+        compact (boolean): return compact frames, see :func:`compact_frame`
+        kwargs (dictionary): query constraints
+
+    Returns:
+      results (generator): pandas.DataFrame, one row for each simulation matching the constraints
+    """
+    project = project.upper()
+    sql, params = local_statement(project, filter_latest, **kwargs)
+    sql = sql.order_by(fix_path_sql(sql.selected_columns.directory + '/', latest))
+
+    con = session.connection().execution_options(stream_results=True)
+    pending = None
+    for chunk in pd.read_sql(sql, con=con, params=params, chunksize=chunksize):
+        df = fix_directories(chunk, latest)
+        if pending is not None:
+            df = pd.concat([pending, df], ignore_index=True)
+        if len(df.index) == 0:
+            continue
+        # the last dataset can continue in the next chunk
+        last = df['path'].iloc[-1]
+        pending = df[df.path == last]
+        df = df[df.path != last]
+        if len(df.index) > 0:
+            yield compact_frame(group_datasets(df, filter_latest), compact)
+    if pending is not None:
+        yield compact_frame(group_datasets(pending, filter_latest), compact)
+
+
+def fix_directories(df, latest):
+    """Add the fixed path of the directories returned by :func:`aggregate_query`
+
+    Args:
+        df (pandas.DataFrame): one row for each directory
+        latest (boolean): True returns only latest version
+
+    Returns:
+        df (pandas.DataFrame): the rows with a valid path
+    """
+    # fix path by substituing output1/2 with combined
+    df['path'] = [os.path.dirname(d) for d in fix_dirs(df['directory'] + '/', latest)]
     # added to eliminate wrong paths for mk3.6.0 once that is fixed might be removed
     df = df[df.path != '/path/todelete']
-    df['filename'] = df['opath'].map(os.path.basename)
+    return df[[c for c in df.columns if c not in ['directory', 'filename']] + ['filename']]
+
+
+def group_datasets(df, filter_latest=False):
+    """Combine the directories with the same fixed path in one dataset
 
-    # group by path
+    Args:
+        df (pandas.DataFrame): directories returned by :func:`fix_directories`
+        filter_latest (boolean): the latest versions were selected by the query
+
+    Returns:
+      results (pandas.DataFrame): each row describe one simulation
+    """
+    # group by fixed path, different directories can be combined in one
     mcols = ['filename','period']
-    agg_dict = {k: ('first' if k not in mcols else set) for k in list(df)}
+    agg_dict = {k: ('first' if k not in mcols else merge_sets) for k in list(df)}
     res = df.groupby(['path']).agg(agg_dict)
 
+    # work out the time axis of all the datasets at once
+    periods, fdate, tdate, complete = period_stats(res['period'].tolist())
+    res['periods'] = pd.Series(periods, index=res.index, dtype=object)
+    res['fdate'] = pd.Series(fdate, index=res.index, dtype=object)
+    res['tdate'] = pd.Series(tdate, index=res.index, dtype=object)
+    res['time_complete'] = pd.Series(complete, index=res.index, dtype=object)
+    # datasets without a version can only be compared once it is taken from the path
+    unversioned = res['version'].isna().any()
     # apply postprocessing function to each row
     res = res.apply(post_local, axis=1)
     # remove unuseful columns
     todel = ['opath','r','i','p','f','period']
     cols = [c for c in todel if c in res.columns]
     res = res.drop(columns=cols)
+    if filter_latest and unversioned:
+        res = local_latest(res)
     return res
 
 
-def build_query(session, project, **kwargs):
+def compact_frame(df, compact=None):
+    """Reduce the memory used by query results
+
+    Columns of strings, i.e. the facets repeated in many rows, are converted to
+    the pandas ``category`` dtype. The filenames and periods of each row are
+    stored as sorted NumPy arrays instead of Python sets and lists.
+
+    Args:
+        df (pandas.DataFrame): query results
+        compact (boolean): convert the results, if None (default) only results
+            with at least :data:`compact_rows` rows are converted
+
+    Returns:
+        df (pandas.DataFrame): the converted results
+    """
+    if compact is None:
+        compact = len(df.index) >= compact_rows
+    if not compact:
+        return df
+    df = df.copy()
+    for c in df.columns:
+        if c == 'filename':
+            df[c] = pd.Series([np.array(sorted(v), dtype=str) for v in df[c]],
+                              index=df.index, dtype=object)
+        elif c == 'periods':
+            df[c] = pd.Series([np.array(sorted(v), dtype=str).reshape(-1, 2) for v in df[c]],
+                              index=df.index, dtype=object)
+        elif c not in unique_columns and pd.api.types.infer_dtype(df[c], skipna=True) == 'string':
+            df[c] = df[c].astype('category')
+    return df
+
+
+def build_query(session, project, latest=False, **kwargs):
     """Build local query syntax.
 
+    The query is built only once for each constraints shape, see
+    :func:`query_shape`, the values of the constraints are bound parameters
+
     Args:
         session (SQLAlchemy obj): the db session
         project (str): data project
+        latest (bool): return only the latest version of each dataset, see :func:`latest_query`
         kwargs (dict): query constraints
 
     Returns:
         r: (str) SQL query syntax to execute 
 
     """   
+    shape = query_shape(project, latest, kwargs)
+    if shape not in _query_cache:
+        _query_cache[shape] = template_query(*shape)
+    return _query_cache[shape].with_session(session).params(**query_params(project, kwargs))
+
+
+def local_statement(project, latest=False, all_of=None, **kwargs):
+    """Return the query of :func:`build_query` aggregated by directory, see
+    :func:`aggregate_query`, and the values of its parameters
 
-    # for cmip5, cordex separate var from other constraints 
-    if project in ['CMIP5', 'CORDEX'] and 'variable' in kwargs:
-        var = kwargs.pop('variable')
-    if project in ['CMIP5', 'CORDEX'] and 'experiment_family' in kwargs.keys():
-        family = kwargs.pop('experiment_family')
-    if project == 'CMIP6' and 'activity_id' in kwargs.keys():
-        activity = kwargs.pop('activity_id')
-    ctables={'CMIP5': [C5Dataset, Path.c5dataset],
-          'CMIP6': [C6Dataset, Path.c6dataset],
-          'CORDEX': [CordexDataset, Path.cordexdataset] }
-    family_dict = {'RCP': ['%rcp%'],
-                   'ESM': ['esm%'],
-                   'Atmos-only': ['sst%', 'amip%', 'aqua%'],
-                   'Control': ['sstClim%', '%Control'],
-                   'decadal': ['decadal%','noVolc%', 'volcIn%'],
-                   'Idealized': ['%CO2'],
-                   'All': ['%'],
-                   'Paleo': ['lgm','midHolocene', 'past1000'],
-                   'Historical': ['historical%','%Historical']}
-
-    r = (session.query(Path.path.label('path'),
-         *[c.label(c.name) for c in ctables[project][0].__table__.columns if c.name != 'dataset_id'],
-         *[c.label(c.name) for c in ExtendedMetadata.__table__.columns if c.name != 'file_id']
-        )
+    The statement is built only once for each constraints shape, so that only
+    the values of the parameters change between queries
+
+    Args:
+        project (str): data project
+        latest (bool): return only the latest version of each dataset
+        all_of (tuple): lists of attributes (cols, fixed), return only the
+            simulations that have all the values of cols, see :func:`all_of_query`
+        kwargs (dict): query constraints
+
+    Returns:
+        tuple (SQLAlchemy select, parameters dict)
+    """
+    shape = query_shape(project, latest, kwargs)
+    params = query_params(project, kwargs)
+    table = dataset_tables[project][0]
+    names = [c.name for c in [*table.__table__.columns, *ExtendedMetadata.__table__.columns]
+             if c.name not in filter_columns]
+    # otherwise the results are only filtered by and_filter
+    if all_of is not None and all(c in kwargs and c in names for c in all_of[0]) \
+            and all(f in names for f in all_of[1]):
+        cols, fixed = all_of
+        shape += ((tuple(cols), tuple(fixed)),)
+        params['and_count'] = len(list(itertools.product(*[as_list(kwargs[c]) for c in cols])))
+    if shape not in _statement_cache:
+        r = template_query(*shape[:3])
+        if len(shape) > 3:
+            r = all_of_query(r, *shape[3])
+        _statement_cache[shape] = aggregate_query(r)
+    return _statement_cache[shape], params
+
+
+def all_of_query(r, cols, fixed):
+    """Select only the files of the simulations that have all the values of some attributes
+
+    The SQL version of :func:`and_filter`, a simulation is a group of files
+    with the same fixed attributes, and it is selected if it has as many
+    distinct combinations of the cols attributes as the `and_count` parameter
+
+    Args:
+        r: query built by :func:`template_query`
+        cols (list): attributes for which all values should be present
+        fixed (list): attributes used to define a simulation (i.e. model/ensemble)
+
+    Returns:
+        query with the same columns as r
+    """
+    files = r.cte('files')
+    combinations = func.count(sa.distinct(sa.tuple_(*[files.c[c] for c in cols])))
+    simulations = (sa.select(*[files.c[f] for f in fixed])
+                   .group_by(*[files.c[f] for f in fixed])
+                   .having(combinations == bindparam('and_count')))
+    return (sa.orm.Query([c for c in files.c])
+            .filter(sa.tuple_(*[files.c[f] for f in fixed]).in_(simulations)))
+
+
+def query_shape(project, latest, kwargs):
+    """Return the key of the cached queries, i.e. the project, latest and the
+    names of the constraints, noting the ones that are a list of values, i.e.
+    those with more than one value or none
+
+    >>> query_shape('CMIP6', True, {'variable_id': ['tas', 'pr'], 'source_id': 'A'})
+    ('CMIP6', True, (('source_id', False), ('variable_id', True)))
+    """
+    return (project, latest, tuple(sorted((k, len(as_list(v)) != 1) for k, v in kwargs.items())))
+
+
+def query_params(project, kwargs):
+    """Convert the constraints to the parameters of the query built by :func:`template_query`
+
+    Args:
+        project (str): data project
+        kwargs (dict): query constraints
+
+    Returns:
+        params (dict): value or list of values of each constraint, an empty
+        list matches nothing
+    """
+    params = {}
+    for k, v in kwargs.items():
+        values = as_list(v)
+        if (project in ['CMIP5', 'CORDEX'] and k == 'experiment_family') or \
+                (project == 'CMIP6' and k == 'activity_id'):
+            params[k] = values
+        else:
+            params[k] = values if len(values) != 1 else values[0]
+    return params
+
+
+def template_query(project, latest, constraints):
+    """Build the local query for a constraints shape, see :func:`query_shape`
+
+    Each constraint is matched to a bound parameter with the same name, the
+    query has no session
+
+    Args:
+        project (str): data project
+        latest (bool): return only the latest version of each dataset
+        constraints (tuple): pairs of constraint name, True if it is a list of values
+
+    Returns:
+        r: SQLAlchemy ORM query
+    """
+    table, link = dataset_tables[project]
+    r = (sa.orm.Query([Path.path.label('path'),
+         *[c.label(c.name) for c in table.__table__.columns if c.name not in ['dataset_id', *filter_columns]],
+         *[c.label(c.name) for c in ExtendedMetadata.__table__.columns if c.name != 'file_id']])
         .join(Path.extended)
-        .join(ctables[project][1])
-        .filter_by(**kwargs))
-    if 'family' in locals() and project == 'CMIP5':
-          r =r.filter(C5Dataset.experiment.like(any_(family_dict[family])))
-    if 'family' in locals() and project == 'CORDEX':
-          r =r.filter(CordexDataset.experiment.like(any_(family_dict[family])))
-    if 'var' in locals(): 
-        r = r.filter(ExtendedMetadata.variable == var)
-    if 'activity' in locals():
-          r =r.filter(C6Dataset.activity_id.like("%"+activity+"%"))
+        .join(link))
+    for k, multi in constraints:
+        # families and activities are arrays with a GIN index, match any of the values
+        if project in ['CMIP5', 'CORDEX'] and k == 'experiment_family':
+            r = r.filter(table.experiment_family.overlap(bindparam(k, type_=ARRAY(sa.Text))))
+        elif project == 'CMIP6' and k == 'activity_id':
+            r = r.filter(table.activity_ids.overlap(bindparam(k, type_=ARRAY(sa.Text))))
+        # for cmip5, cordex the variable is in the extended metadata
+        elif project in ['CMIP5', 'CORDEX'] and k == 'variable':
+            r = r.filter(match_any(ExtendedMetadata.variable, k, multi))
+        else:
+            r = r.filter(match_any(getattr(table, k), k, multi))
+    if latest:
+        r = latest_query(r, table)
     return r
 
 
+def latest_query(r, table):
+    """Select only the files of the latest version of each dataset
+
+    The files are ranked by version within each group of files with the same
+    dataset attributes and variable, the version is taken from the path if it
+    is not stored in the database. Files without a version are all returned,
+    :func:`local_query` selects between them with :func:`local_latest`.
+
+    Args:
+        r: query built by :func:`template_query`
+        table: dataset table of the project
+
+    Returns:
+        query with the same columns as r
+    """
+    version = version_key_sql(ExtendedMetadata.version, Path.path)
+    facets = [c for c in table.__table__.columns
+              if c.name not in ['dataset_id', 'r', 'i', 'p', 'f', *filter_columns]]
+    rank = func.dense_rank().over(partition_by=[*facets, ExtendedMetadata.variable],
+                                  order_by=version.desc().nulls_last())
+    q = r.add_columns(rank.label('version_rank'), version.label('version_key')).subquery()
+    return (sa.orm.Query([c for c in q.c if c.name not in ['version_rank', 'version_key']])
+            .filter(sa.or_(q.c.version_rank == 1, q.c.version_key == None)))
+
+
+def as_list(value):
+    """Return a constraint value as a list, a single value becomes a one element list
+    """
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
+
+
+def match_any(col, name, multi=False):
+    """Filter on a column matching the value of a bound parameter, or any of its values
+
+    Multiple values are passed as a single array parameter, i.e. `col = ANY(:name)`
+
+    Args:
+        col (SQLAlchemy column): column to filter
+        name (str): name of the parameter
+        multi (bool): the parameter is a list of accepted values
+
+    Returns:
+        filter expression
+    """
+    if not multi:
+        return col == bindparam(name)
+    return col == any_(bindparam(name, type_=ARRAY(col.type)))
+
+
+def aggregate_query(r):
+    """Aggregate the files returned by :func:`build_query` by directory
+
+    Returns one row for each directory, with the lists of filenames and
+    periods of its files, the other columns are taken from any of the files
+
+    Args:
+        r: query returned by :func:`build_query`
+
+    Returns:
+        SQLAlchemy select
+    """
+    files = r.subquery()
+    directory = func.regexp_replace(files.c.path, '/[^/]*$', '')
+    cols = []
+    for c in files.c:
+        if c.name == 'path':
+            cols.append(func.array_agg(func.regexp_replace(c, '^.*/', '')).label('filename'))
+        elif c.name == 'period':
+            cols.append(func.array_agg(c).label('period'))
+        else:
+            cols.append(func.min(c).label(c.name))
+    return (sa.select(directory.label('directory'), *cols)
+            .group_by(directory))
+
+
+def merge_sets(values):
+    """Merge lists of values in a set
+    """
+    return set(itertools.chain.from_iterable(values))
+
+
 def post_local(row):
     """Postprocess local query results row by row 
+
+    The periods columns are added beforehand by :func:`clef.helpers.period_stats`
     """ 
-    row['periods'] = convert_periods(row['period'])
-    row['fdate'], row['tdate'] = get_range(row['periods'])
-    row['time_complete'] = time_axis(row['periods'],row['fdate'],row['tdate'])
     # make sure a version is available even for CMIP6 where is usually None
     if row['version'] is None:
         row['version'] = get_version(row['path'])
@@ -299,19 +724,21 @@ def and_filter(df, cols, fixed, **kwargs):
         'cmor_table','table_id', 'ensemble', 'member_id', 'driving_experiment',
         'model_id', 'frequency', 'driving_model', 'rcm_version']) - set(fixed)
     fields = ['comb'] + [f for f in useful if f in [c for c in df.columns.values]]
+    # sets of categories can't be stored as categories, aggregate them as objects
+    df2 = df2.astype({f: object for f in fields if isinstance(df2[f].dtype, pd.CategoricalDtype)})
     # define the aggregation dictionary
     agg_dict = {k: set for k in fields}
     agg_dict['index'] = lambda x: tuple(x)
     # group table data by the columns listed in 'fixed' i.e. model and ensemble
     # and aggregate rows with matching values creating a set for each including path and version
-    d = (df2.groupby(fixed)
+    d = (df2.groupby(fixed, observed=True)
        .agg(agg_dict))
     # create a filter to select the rows where the lenght of the simulation combinations 
     # is equal to the number of "cols" combinations and apply to table
     selection = d[d['comb'].map(len) == len(comb)]
     # select full rows from original dataframe using original index 
     if len(selection.index) > 0 :
-        fullrow = df2[df2.index.isin(selection['index'].sum())]
+        fullrow = df2[df2.index.isin(list(itertools.chain.from_iterable(selection['index'])))]
     else:
         fullrow = pd.DataFrame(columns=df2.columns)
     return fullrow, selection
@@ -320,24 +747,45 @@ def and_filter(df, cols, fixed, **kwargs):
 def write_csv(df):
     """Write query results to csv file
     """
-    if len(df.index) == 0:
-        print(f'Nothing to write to csv file')
-        return
-    if 'cordex_domain' in df.columns:
-        project = 'CORDEX'
-    elif 'experiment_id' in df.columns:
-        project = 'CMIP6'
-    else:
-        project = 'CMIP5'
-    csv_file = f"{project}_query.csv"
-    ignore = ['periods', 'filename', 'institute', 'project', 'institution_id','realm', 'product']
-    columns = [x for x in df.columns if x not in ignore]
+    write_csv_chunks([df])
+
+
+def write_csv_chunks(chunks):
+    """Write query results to csv file one chunk at a time
+
+    Args:
+        chunks (iterable): pandas.DataFrame with the same columns, i.e. the
+            output of :func:`local_query_chunks`
+    """
+    csvfile = None
     try:
-        with open(csv_file, 'w') as csvfile:
-            csvfile.write(df[columns].to_csv())
-        print(f'Saving to {csv_file}')
+        for df in chunks:
+            if len(df.index) == 0:
+                continue
+            if csvfile is None:
+                if 'cordex_domain' in df.columns:
+                    project = 'CORDEX'
+                elif 'experiment_id' in df.columns:
+                    project = 'CMIP6'
+                else:
+                    project = 'CMIP5'
+                csv_file = f"{project}_query.csv"
+                ignore = ['periods', 'filename', 'institute', 'project', 'institution_id','realm', 'product']
+                columns = [x for x in df.columns if x not in ignore]
+                csvfile = open(csv_file, 'w')
+                header = True
+            csvfile.write(df[columns].to_csv(header=header))
+            header = False
     except IOError:
         print("I/O error")
+        return
+    finally:
+        if csvfile is not None:
+            csvfile.close()
+    if csvfile is None:
+        print(f'Nothing to write to csv file')
+    else:
+        print(f'Saving to {csv_file}')
 
 
 def stats(results, project):
@@ -354,7 +802,7 @@ def stats(results, project):
 
     attrs = get_facets(project)
     # group results by model and create members list, finally count memebrs number for each model
-    member_by_model = results.groupby(attrs['m'])[attrs['en']] \
+    member_by_model = results.groupby(attrs['m'], observed=True)[attrs['en']] \
                         .agg(members='unique', count='nunique')
     return member_by_model 
 
@@ -406,36 +854,21 @@ def local_latest(results):
     return results
 
 
-def ids_df(dids):
+def ids_df(dids, compact=None):
     """Convert dataset_ids in DataFrame in same style as query results
 
     Args:
       dids (list): list of dataset_ids
+      compact (boolean): return a compact frame, see :func:`compact_frame`
 
     Returns:
         results (pandas.DataFrame): each row describes one simulation matching the constraints
 
     """
-    project = dids[0].split(".")[0]
-    facets = get_facets(project.upper())
-    if project == 'CMIP6':
-        facets_list = ['project', 'activity_id', 'institution_id', 'source_id',
-                  'experiment_id', 'member_id', 'table_id', 'variable_id',
-                  'grid_label', 'version']
-    elif project == 'cmip5':
-        facets_list = ['project', 'product', 'institute', 'model', 'experiment',
-                       'time_frequency', 'realm', 'cmor_table', 'ensemble', 'version']
-    elif project == 'cordex':
-        facets_list = ['project', 'product', 'domain', 'institute', 'driving_model',
-             'driving_experiment', 'ensemble', 'model_id', 'rcm_version', 'frequency',
-             'variable', 'version']
-    else:
-        print(f'Warning: project {project} not available')
-        return results 
-    res_list = []
-    for i, did in enumerate(dids):
-        df = pd.DataFrame([{k:v for k,v in zip(facets_list,did.split("."))}], index=[i], columns=facets_list)
-        res_list.append(df)
-    results = pd.concat(res_list, ignore_index=True)
-    return results
+    try:
+        results = parse_ids(dids)
+    except ClefException as e:
+        print(f'Warning: {e}')
+        return pd.DataFrame()
+    return compact_frame(results, compact)
 
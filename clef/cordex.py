@@ -20,7 +20,7 @@ import functools
 import click
 
 from clef.esgf import esgf_query
-from clef.helpers import load_vocabularies
+from clef.helpers import VocabChoice
 
 def tidy_facet_count(v):
     return v[::2]
@@ -77,15 +77,15 @@ class CordexCommand(click.Command):
         super().__init__(*args, **kwargs)
 
         #facets = get_esgf_facets(project="CORDEX,CORDEX-Adjust,CORDEX-ESD,CORDEXReklies")
-        facets = load_vocabularies('CORDEX')
-        facets['rcm_name'].append('CCAM-1391M')
+        # values not in the vocabularies
+        extra = {'rcm_name': ['CCAM-1391M']}
         for k, v in cli_facets.items():
             opt = click.Option(
                 [f"--{k}"] + v['short'], help=v["help"], multiple=(False if 'one' in v.keys() else True), metavar="FACET"
             )
 
             if v.get("controlled_vocab", False):
-                opt.type = click.Choice(facets[k], case_sensitive=False)
+                opt.type = VocabChoice('CORDEX', k, extra=extra.get(k, ()), case_sensitive=False)
 
             self.params.append(opt)
 
@@ -25,6 +25,8 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from datetime import datetime
 
+from .drs import normalize_ids
+
 
 def write_request(project, missing):
     """Write missing dataset_ids to file to create download request for synda
@@ -136,20 +138,15 @@ def find_dids(qm, rows, dids, project, varlist):
     :return: queued - a dictionary with (did+var,status) for CMIP5 and (did,status) for CMIP6
              filtered based on query results
     """
-    queued={}
-    for q in qm:
-        did = q[0].replace('output.','output1.')
-        if did in dids:
-        # when CMIP5 you need to match also the variable
-            if project == "CMIP5":
-                if varlist != []:
-                    queued.update({k[0]+" "+k[1]: v for k,v in rows.items() if k[0]==did and k[1] in varlist})
-                else:
-                    queued.update({k[0]+" "+k[1]: v for k,v in rows.items() if k[0]==did})
-            elif project == "CMIP6":
-                queued.update({k: v for k,v in rows.items() if k==did})
-            else:
-                 pass
+    found = set(normalize_ids([q[0] for q in qm])) & set(dids)
+    # when CMIP5 you need to match also the variable
+    if project == "CMIP5":
+        queued = {k[0]+" "+k[1]: v for k,v in rows.items() if k[0] in found
+                  and (varlist == [] or k[1] in varlist)}
+    elif project == "CMIP6":
+        queued = {k: v for k,v in rows.items() if k in found}
+    else:
+        queued = {}
     return queued
 
 def search_queue_csv(qm, project, varlist):
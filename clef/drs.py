@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# Copyright 2023 ARC Centre of Excellence for Climate Extremes
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Conversion between dataset ids and facets
+
+The facets making up the dataset ids (DRS) of each project are listed in
+``data/dataset_ids.json``. All the functions work on a whole list or
+:class:`pandas.Series` of ids at once, using vectorised string operations.
+
+* :func:`parse_ids` splits dataset ids into a DataFrame with one column per facet
+* :func:`build_ids` joins the facet columns of a DataFrame into dataset ids
+* :func:`normalize_ids` removes the data node and fixes the CMIP5 product
+"""
+
+import json
+import functools
+import pkg_resources
+import pandas as pd
+
+from .exception import ClefException
+
+
+@functools.lru_cache()
+def _templates():
+    fids = pkg_resources.resource_filename(__name__, 'data/dataset_ids.json')
+    with open(fids, 'r') as f:
+        return json.loads(f.read())
+
+
+def id_facets(project):
+    """Return the facets making up the dataset ids of a project
+
+    >>> id_facets('cmip5')[:3]
+    ['project', 'product', 'institute']
+
+    Args:
+        project (str): project name, case insensitive
+
+    Returns:
+        list: facet names in the order they appear in the ids
+    """
+    try:
+        return list(_templates()[project.upper()])
+    except KeyError:
+        raise ClefException(f'No dataset id template for project {project}')
+
+
+def as_series(ids):
+    """Return ids as a Series, keeping the index of a Series
+    """
+    if isinstance(ids, pd.Series):
+        return ids
+    return pd.Series(list(ids), dtype=str)
+
+
+def normalize_ids(ids):
+    """Normalise dataset ids
+
+    Removes the ``|data_node`` suffix of ESGF instance ids and replaces the
+    CMIP5 ``output`` product with ``output1``, as used in the local collections
+
+    >>> normalize_ids(['cmip5.output.MIROC.MIROC5.historical.day.atmos.day.r2i1p1.v1|esgf.nci.org.au']).tolist()
+    ['cmip5.output1.MIROC.MIROC5.historical.day.atmos.day.r2i1p1.v1']
+
+    Args:
+        ids (list or pandas.Series): dataset ids
+
+    Returns:
+        pandas.Series: normalised ids
+    """
+    s = as_series(ids)
+    s = s.str.split('|', n=1).str[0]
+    return s.str.replace('output.', 'output1.', regex=False)
+
+
+def parse_ids(ids, project=None):
+    """Split dataset ids into their facets
+
+    Ids are kept as they are, use :func:`normalize_ids` first to remove the
+    data node and fix the product
+
+    >>> parse_ids(['CMIP6.CMIP.NCC.NorESM2-LM.historical.r3i1p1f1.day.tas.gn.v20190920']).loc[0, 'source_id']
+    'NorESM2-LM'
+
+    Args:
+        ids (list or pandas.Series): dataset ids, all from the same project
+        project (str): project of the ids, by default the first facet of the first id
+
+    Returns:
+        pandas.DataFrame: one column per facet, missing facets are None
+    """
+    s = as_series(ids)
+    if project is None:
+        if len(s) == 0:
+            raise ClefException('Cannot guess the project of an empty list of ids')
+        project = s.iloc[0].split('.', 1)[0]
+    facets = id_facets(project)
+    if len(s) == 0:
+        return pd.DataFrame(columns=facets, dtype=str)
+    df = s.str.split('.', n=len(facets)-1, expand=True)
+    df.columns = facets[:df.shape[1]]
+    return df.reindex(columns=facets)
+
+
+def build_ids(df, project, nfacets=None):
+    """Join the facet columns of a DataFrame into dataset ids
+
+    Missing versions are replaced by 'none'. If df has no project column the
+    project name is used for all the ids
+
+    >>> df = pd.DataFrame({'activity_id': ['CMIP'], 'institution_id': ['NCC'], 'source_id': ['NorESM2-LM']})
+    >>> build_ids(df, 'CMIP6', nfacets=4)
+    ['CMIP6.CMIP.NCC.NorESM2-LM']
+
+    Args:
+        df (pandas.DataFrame): one row for each id, with a column for each facet
+        project (str): project of the ids
+        nfacets (int): use only the first nfacets facets, e.g. to build the
+            id of a whole simulation
+
+    Returns:
+        list: dataset ids
+    """
+    facets = id_facets(project)[:nfacets]
+    if len(df) == 0:
+        return []
+    cols = []
+    for f in facets:
+        if f in df.columns:
+            cols.append(df[f].astype(str).where(df[f].notna(), 'none'))
+        elif f == 'project':
+            cols.append(pd.Series(project, index=df.index, dtype=str))
+        else:
+            raise ClefException(f'Missing facet {f} to build {project} dataset ids')
+    return cols[0].str.cat(cols[1:], sep='.').tolist()
@@ -23,6 +23,8 @@ import json
 from bs4 import BeautifulSoup
 from datetime import date
 
+from .drs import parse_ids, build_ids
+
 
 def esdoc_urls(dataset_ids):
     """
@@ -152,13 +154,14 @@ def citation(dids):
     '''
     citations = []
     url = 'https://www.wdc-climate.de/ui/cerarest/cmip6Citations?drsId='
-    for did in dids:
-        # get facets from did to build correct url
-        did_bits = did.split(".")
-        version = did_bits[9]
-        newdid = ".".join(did_bits[0:5])
-        response = requests.get(url+newdid, headers={"User-Agent": "Requests"})
-        cite = response.json()[0]['DATA_REFERENCE']
+    # get facets from dids to build correct url, one request for each simulation
+    df = parse_ids(dids, 'CMIP6')
+    refs = {}
+    for newdid, version in zip(build_ids(df, 'CMIP6', nfacets=5), df['version']):
+        if newdid not in refs:
+            response = requests.get(url+newdid, headers={"User-Agent": "Requests"})
+            refs[newdid] = response.json()[0]['DATA_REFERENCE']
+        cite = refs[newdid]
         if version == 'none':
             now = date.today()
             citations.append(cite.replace("Version YYYYMMDD[1]",f'Accessed on {now}'))
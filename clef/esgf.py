@@ -19,26 +19,49 @@ Functions for searching the ESGF and matching the results against the local DB
 database
 
 * :func:`esgf_query` performs a query against the ESGF web API.
+  All queries share a pooled keep-alive HTTP session (see
+  :func:`get_http_session`) and try the index nodes listed in
+  :data:`esgf_nodes` in order (see :func:`configure_esgf`).
+* :func:`esgf_docs` pages through all the results of :func:`esgf_query`,
+  fetching the pages concurrently.
+* :func:`split_docs` splits a large search into smaller searches along the
+  ESGF facets, and runs them concurrently.
+* :func:`match_datasets` compares whole ESGF datasets with the local
+  datasets, so that only the incomplete ones need to be matched file by file
 * :func:`match_query` performs an outer join of the :func:`esgf_query` results
   against the :class:`clef.model.Path` table
 * :func:`find_local_path` and :func:`find_missing_id` use the results of
   :func:`match_query` to return the files that are replicated locally and
-  missing from the replica respectively.
+  missing from the replica respectively, :func:`find_local_missing` returns
+  both with a single query.
 """
 
 
 import requests
 import sys
+import os
+import logging
+import collections
+import codecs
+import json
+import re
+import time
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 import sqlalchemy as sa
 import pandas as pd
 
 from sqlalchemy.sql import column
-from sqlalchemy.sql import values as sqlalvalues
 from sqlalchemy import String, Float, Integer, or_, func
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-#from .pgvalues import values
-from .model import Path, Checksum, C6Dataset, C5Dataset, CordexDataset
+from .pgvalues import array_values
+from .model import Path, Checksum, C6Dataset, C5Dataset, CordexDataset, ExtendedMetadata
 from .exception import ClefException
+from .cache import get_cache, canonical_key, cache_config
+from .helpers import version_digits, version_key_sql
 
 
 class ESGFException(ClefException):
@@ -47,7 +70,298 @@ class ESGFException(ClefException):
     pass
 
 
-def esgf_query(query=None, fields=[], otype='File', limit=10000, offset=0,  distrib=True, replica=False, latest=None,  **kwargs):
+#: Ordered list of ESGF index nodes search API urls, the first node that
+#: answers is used. Can be set with the CLEF_ESGF_NODES environment variable
+#: (comma separated urls) or :func:`configure_esgf`
+esgf_nodes = os.environ.get('CLEF_ESGF_NODES',
+        'https://esgf.nci.org.au/esg-search/search,'
+        'https://esgf-node.llnl.gov/esg-search/search').split(',')
+
+#: Settings of the pooled HTTP session, timeout is (connect, read) in seconds.
+#: If hedge is True a query is also sent to the next node when the current one
+#: hasn't answered within hedge_percentile of its recent response times
+#: (hedge_delay seconds until enough responses have been timed). pool_size
+#: should allow for every concurrent request to a node, by default the
+#: :data:`clef.aio.max_concurrency` searches with 4 page requests each, otherwise
+#: the extra connections are discarded instead of kept alive
+http_config = {
+        'timeout': (10, 120),
+        'retries': 3,
+        'backoff': 0.5,
+        'pool_size': 32,
+        'hedge': False,
+        'hedge_delay': 2.0,
+        'hedge_percentile': 95,
+        }
+
+#: Recent response times in seconds of each ESGF node
+node_latency = collections.defaultdict(lambda: collections.deque(maxlen=100))
+_latency_lock = threading.Lock()
+
+_http_session = None
+
+
+def get_http_session():
+    """Return the HTTP session shared by all the ESGF queries
+
+    The session is created on first use and keeps connections alive between
+    queries, with a separate connection pool for each index node. Failed
+    connections and server errors are retried with an exponential backoff.
+
+    Returns:
+        :class:`requests.Session`
+    """
+    global _http_session
+    if _http_session is None:
+        retry = Retry(total=http_config['retries'],
+                      backoff_factor=http_config['backoff'],
+                      status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=max(len(esgf_nodes), 1),
+                              pool_maxsize=http_config['pool_size'],
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _http_session = session
+    return _http_session
+
+
+def configure_esgf(nodes=None, timeout=None, retries=None, backoff=None, pool_size=None,
+                   hedge=None, hedge_delay=None, hedge_percentile=None):
+    """Change the ESGF index nodes and HTTP settings used by :func:`esgf_query`
+
+    The shared HTTP session is closed and will be recreated with the new
+    settings by the next query.
+
+    Args:
+        nodes (list): ESGF search API urls, in the order they should be tried
+        timeout (tuple): (connect, read) timeouts in seconds
+        retries (int): Number of retries for each node
+        backoff (float): Backoff factor between retries
+        pool_size (int): Maximum number of connections kept open for each node
+        hedge (bool): Send hedged requests to the next nodes, see :func:`esgf_get`
+        hedge_delay (float): Seconds to wait before hedging while a node has no
+            latency statistics
+        hedge_percentile (float): Percentile of a node's response times after
+            which the request is hedged
+    """
+    global _http_session
+    if nodes is not None:
+        esgf_nodes[:] = list(nodes)
+    for k, v in [('timeout', timeout), ('retries', retries),
+                 ('backoff', backoff), ('pool_size', pool_size), ('hedge', hedge),
+                 ('hedge_delay', hedge_delay), ('hedge_percentile', hedge_percentile)]:
+        if v is not None:
+            http_config[k] = v
+    if _http_session is not None:
+        _http_session.close()
+        _http_session = None
+
+
+def hedge_delay(node):
+    """Return how long to wait for an answer from node before hedging
+
+    This is the `hedge_percentile` of the node's recent response times, or
+    the default `hedge_delay` if fewer than 5 responses have been timed.
+
+    Args:
+        node (str): ESGF search API url
+
+    Returns:
+        float: delay in seconds
+    """
+    with _latency_lock:
+        samples = sorted(node_latency[node])
+    if len(samples) < 5:
+        return http_config['hedge_delay']
+    i = int(round((len(samples) - 1) * http_config['hedge_percentile'] / 100))
+    return samples[i]
+
+
+def node_get(session, node, params, stream=False):
+    """Send a request to a single ESGF node, recording its response time
+    """
+    start = time.monotonic()
+    r = session.get(node, params=params, timeout=http_config['timeout'],
+                    stream=stream)
+    r.raise_for_status()
+    with _latency_lock:
+        node_latency[node].append(time.monotonic() - start)
+    return r
+
+
+def _close_response(future):
+    """Release the connection of a request that is no longer needed"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def esgf_get(params, stream=False):
+    """Send a search request to the ESGF index nodes
+
+    Each node in :data:`esgf_nodes` is tried in order until one returns a
+    successful response.
+
+    If `hedge` is set in :data:`http_config` the same request is also sent to
+    the next node when a node is slower than usual (see
+    :func:`hedge_delay`) or fails, and the first successful answer is used.
+    The requests still pending are cancelled, or closed as soon as they return.
+
+    Args:
+        params (dict): Search API parameters
+        stream (bool): Don't download the response body straight away
+
+    Returns:
+        :class:`requests.Response` from the first node that answered
+    """
+    session = get_http_session()
+    debug_logger = logging.getLogger('clef_debug')
+    if http_config['hedge'] and len(esgf_nodes) > 1:
+        nodes = iter(list(esgf_nodes))
+        pending = {}
+        last = None
+        def launch():
+            nonlocal last
+            node = next(nodes, None)
+            if node is not None:
+                pending[executor.submit(node_get, session, node, params, stream)] = node
+                last = node
+            return node is not None
+
+        executor = ThreadPoolExecutor(max_workers=len(esgf_nodes))
+        try:
+            launch()
+            while pending:
+                done, _ = wait(pending, timeout=hedge_delay(last), return_when=FIRST_COMPLETED)
+                if not done:
+                    # too slow, send the same request to the next node
+                    if launch():
+                        debug_logger.debug(f'ESGF node {last} hedged after {hedge_delay(last)}s')
+                        continue
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    node = pending.pop(f)
+                    try:
+                        return f.result()
+                    except requests.exceptions.RequestException as err:
+                        debug_logger.debug(f'ESGF node {node} failed: {err}')
+                        launch()
+        finally:
+            for f in pending:
+                f.cancel()
+                f.add_done_callback(_close_response)
+            executor.shutdown(wait=False)
+    else:
+        for node in esgf_nodes:
+            try:
+                return node_get(session, node, params, stream)
+            except requests.exceptions.RequestException as err:
+                debug_logger.debug(f'ESGF node {node} failed: {err}')
+    raise ESGFException(f'Currently is not possible to contact one of the ESGF nodes try again later or use --local option')
+
+
+class SolrDocStream:
+    """Incrementally decode the documents of a Solr JSON search response
+
+    The response header, up to the start of the ``docs`` array, is read when
+    the stream is created. Iterating over the stream then decodes each
+    document as soon as it has been received, so the full response is never
+    held in memory.
+
+    The response is closed, releasing its pooled connection, when all the
+    documents have been read, when the iteration is stopped early or when
+    :meth:`close` is called. The stream can also be used as a context manager.
+
+    Args:
+        chunks: Iterable of bytes, e.g. :meth:`requests.Response.iter_content`
+        response (requests.Response): Response the chunks are read from
+
+    Attributes:
+        num_found (int): Total number of documents matching the search
+        rows (int): Number of documents in this page, if listed in the header
+    """
+    _docs_start = re.compile(r'(?<!\\)"docs"\s*:\s*\[')
+
+    def __init__(self, chunks, response=None):
+        self._response = response
+        self._done = True
+        try:
+            self._start(chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    def _start(self, chunks):
+        self._chunks = iter(chunks)
+        self._decode = codecs.getincrementaldecoder('utf-8')().decode
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        match = None
+        while match is None:
+            if not self._read():
+                break
+            match = self._docs_start.search(self._buf)
+        header = self._buf if match is None else self._buf[:match.start()]
+        found = re.search(r'"numFound"\s*:\s*(\d+)', header)
+        if found is None:
+            raise ESGFException('Unexpected response from ESGF, number of results not found')
+        self.num_found = int(found.group(1))
+        rows = re.search(r'"rows"\s*:\s*"?(\d+)', header)
+        self.rows = int(rows.group(1)) if rows else None
+        # with no docs array there is nothing left to iterate over
+        self._done = match is None
+        self._pos = 0 if match is None else match.end()
+
+    def _read(self):
+        """Append the next chunk to the buffer, returns False at the end of the response"""
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+        self._buf = self._buf[self._pos:] + self._decode(chunk)
+        self._pos = 0
+        return True
+
+    def __iter__(self):
+        try:
+            while not self._done:
+                # skip separators between documents
+                while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n,':
+                    self._pos += 1
+                if self._pos < len(self._buf) and self._buf[self._pos] == ']':
+                    self._done = True
+                    return
+                try:
+                    doc, self._pos = self._decoder.raw_decode(self._buf, self._pos)
+                except ValueError:
+                    # document not fully received yet
+                    if not self._read():
+                        raise ESGFException('Incomplete response from ESGF')
+                    continue
+                yield doc
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop reading the response and release its connection
+        """
+        self._done = True
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, '_response', None) is not None:
+            self.close()
+
+
+def esgf_query(query=None, fields=[], otype='File', limit=10000, offset=0,  distrib=True, replica=False, latest=None, stream=False, ttl=None, **kwargs):
     """Search the ESGF
 
     Searches the ESGF using its `API
@@ -63,10 +377,13 @@ def esgf_query(query=None, fields=[], otype='File', limit=10000, offset=0,  dist
         distrib (bool): Distribute the search across all nodes
         replica (bool): Return replicated datasets
         latest (bool or None): Return only latest (True), only not latest (False) or all versions (None)
+        stream (bool): Decode the response documents incrementally as they are received
+        ttl (int): Maximum age in seconds of a cached response, see :mod:`clef.cache`
         **kwargs: See the `ESGF API docs <https://github.com/ESGF/esgf.github.io/wiki/ESGF_Search_REST_API>`_
 
     Returns:
-        API response from ESGF, decoded from JSON into a Python dict
+        API response from ESGF, decoded from JSON into a Python dict, or a
+        :class:`SolrDocStream` over the response documents if `stream` is True
     """
 
     if latest == 'all':
@@ -90,20 +407,245 @@ def esgf_query(query=None, fields=[], otype='File', limit=10000, offset=0,  dist
     if otype == 'Dataset':
         params.pop('type')
 
-    try:
-        #r = requests.get('https://esgf-node.llnl.gov/esg-search/search',
-        r = requests.get('https://esgf.nci.org.au/esg-search/search',
-                     params = params )
-        r.raise_for_status()
-    except Exception as err:
-        r = requests.get(f'https://esgf-node.llnl.gov/esg-search/search',
-                     params = params )
-        r.raise_for_status()
-    except Exception as err:
-        raise ESGFException(f'Currently is not possible to contact one of the ESGF nodes try again later or use --local option') 
+    # look for a previous identical query in the cache
+    cache = get_cache()
+    if cache is not None:
+        key = canonical_key(params)
+        if not cache_config['refresh']:
+            data = cache.get(key, ttl=(cache_config['ttl'] if ttl is None else ttl))
+            if data is not None:
+                if stream:
+                    return SolrDocStream([data])
+                try:
+                    return json.loads(data)
+                except ValueError:
+                    # not a complete response, query ESGF again
+                    pass
+
+    if stream:
+        # streamed responses are not cached, to avoid keeping them in memory
+        r = esgf_get(params, stream=True)
+        return SolrDocStream(r.iter_content(chunk_size=65536), response=r)
+    r = esgf_get(params)
+    if cache is not None:
+        cache.put(key, r.content)
     return r.json()
 
 
+def esgf_docs(query=None, fields=[], limit=10000, workers=4, stream=False, **kwargs):
+    """Iterate over all the documents matching an ESGF search
+
+    Pages through the results of :func:`esgf_query` using `offset`. After the
+    first page the following pages are fetched concurrently by a bounded
+    thread pool, so the next pages are already downloading while the
+    current one is processed.
+
+    With `stream` the requests for the next pages are still sent ahead, but
+    only the start of their responses is read in advance: each page body is
+    downloaded while its documents are iterated, so the pages are effectively
+    transferred one after another. Use it to limit memory rather than to
+    speed up large searches. Streamed pages that are not read are closed.
+
+    Args:
+        query (str): Full text query
+        fields (list): Fields to return
+        limit (int): Number of results requested for each page
+        workers (int): Maximum number of pages downloaded at the same time
+        stream (bool): Decode each page incrementally while it is downloaded,
+            see :class:`SolrDocStream`
+        **kwargs: See :func:`esgf_query`
+
+    Returns:
+        Iterator of the documents (dict) returned by ESGF, in order
+    """
+    if limit < 1:
+        raise ESGFException('The page limit must be at least 1, use esgf_query(limit=0) to only count the results')
+    kwargs.pop('offset', None)
+    response = esgf_query(query, fields, limit=limit, offset=0, stream=stream, **kwargs)
+    if stream:
+        found, rows = response.num_found, response.rows
+    else:
+        found = response['response']['numFound']
+    if found == 0:
+        if stream:
+            response.close()
+        return
+    yield from (response if stream else response['response']['docs'])
+    # ESGF can return fewer rows than requested, use the actual page size
+    if not stream:
+        rows = response['responseHeader']['params'].get('rows')
+    rows = int(rows or limit)
+    offsets = iter(range(rows, found, rows))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        def submit():
+            offset = next(offsets, None)
+            if offset is not None:
+                pending.append(executor.submit(esgf_query, query, fields,
+                    limit=rows, offset=offset, stream=stream, **kwargs))
+        try:
+            for _ in range(workers):
+                submit()
+            while pending:
+                page = pending.popleft().result()
+                submit()
+                yield from (page if stream else page['response']['docs'])
+        finally:
+            for f in pending:
+                f.cancel()
+                if stream:
+                    f.add_done_callback(_close_response)
+
+
+#: Facets used to split searches that are too large, the facet giving the most
+#: even split is chosen
+split_facets = ['source_id', 'model', 'rcm_name', 'variable_id', 'variable',
+                'member_id', 'ensemble', 'experiment_id', 'experiment',
+                'table_id', 'cmor_table', 'domain', 'driving_model']
+
+
+def facet_counts(query=None, facets=[], **kwargs):
+    """Count the results of an ESGF search for each value of some facets
+
+    Runs a search with `limit=0`, so no documents are returned
+
+    Args:
+        query (str): Full text query
+        facets (list): Facets to count
+        **kwargs: See :func:`esgf_query`
+
+    Returns:
+        Total number of results and a dictionary {facet: {value: count}}
+    """
+    kwargs.pop('limit', None)
+    kwargs.pop('offset', None)
+    response = esgf_query(query, limit=0, facets=','.join(facets), **kwargs)
+    return response['response']['numFound'], _facet_fields(response)
+
+
+def _facet_fields(response):
+    # convert the flat [value, count, ...] lists returned by ESGF to dicts
+    fields = response.get('facet_counts', {}).get('facet_fields', {})
+    return {k: dict(zip(v[::2], v[1::2])) for k, v in fields.items()}
+
+
+def _concurrent_docs(query, fields, searches, workers=4, **kwargs):
+    # run independent searches concurrently, yielding the documents of each
+    # search as soon as it has completed
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(lambda c: list(esgf_docs(query, fields, workers=1, **kwargs, **c)), c)
+                   for c in searches]
+        try:
+            for f in as_completed(futures):
+                yield from f.result()
+        finally:
+            for f in futures:
+                f.cancel()
+
+
+def split_docs(query=None, fields=[], limit=10000, workers=4, **kwargs):
+    """Iterate over the documents matching an ESGF search, splitting it if too large
+
+    The first page of the search is requested together with the facet
+    counts, if it holds all the results nothing else is searched. If the
+    search returns more than `limit` results it is split into one
+    search for each value of the facet in :data:`split_facets` that divides
+    the results most evenly, among the facets that have a value for every
+    result. If no facet does, the results without a value are found by a
+    search excluding the split values (``facet!=value``). Searches that are
+    still too large are split again along another facet until each of them
+    fits in a single page. The searches are then run concurrently and their
+    results merged, removing duplicates.
+
+    Args:
+        query (str): Full text query
+        fields (list): Fields to return
+        limit (int): Maximum number of results of each search
+        workers (int): Maximum number of searches running at the same time
+        **kwargs: See :func:`esgf_query`
+
+    Returns:
+        Iterator of the documents (dict) returned by ESGF, in no particular order
+    """
+    if limit < 1:
+        raise ESGFException('The page limit must be at least 1, use facet_counts to only count the results')
+    kwargs.pop('offset', None)
+
+    def splittable(constraints):
+        # facets already fixed to a single value can't be used to split
+        return [f for f in split_facets if isinstance(constraints.get(f, ()), (list, tuple))
+                and len(constraints.get(f, ())) != 1]
+
+    # most searches fit in a single page, only split the others
+    first = esgf_query(query, fields, limit=limit, offset=0,
+                       facets=','.join(splittable(kwargs)), **kwargs)
+    found = first['response']['numFound']
+    if found <= len(first['response']['docs']):
+        yield from first['response']['docs']
+        return
+
+    leaves = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def count(constraints):
+            return facet_counts(query, splittable(constraints), **constraints)
+
+        # plan the searches one level at a time, only the searches that are
+        # still too large need another count. Each search is listed with the
+        # number of results it should return (None if unknown) and the search
+        # to page through instead if it doesn't
+        frontier = [(kwargs, None, None)]
+        results = [(found, _facet_fields(first))]
+        while frontier:
+            next_frontier = []
+            for (constraints, expected, parent), (found, counts) in zip(frontier, results):
+                if expected is not None and found != expected:
+                    # the index didn't apply the exclusion, page through the parent search
+                    leaves.append(parent)
+                    continue
+                if found <= limit:
+                    if found > 0:
+                        leaves.append(constraints)
+                    continue
+                splits = {k: {v: n for v, n in c.items() if n > 0} for k, c in counts.items()}
+                splits = {k: c for k, c in splits.items() if len(c) > 1}
+                if not splits:
+                    # can't be split any further, use paging
+                    leaves.append(constraints)
+                    continue
+                # prefer the facets with a value for every result, documents
+                # without a value for the facet would be in none of the searches.
+                # Otherwise use a facet where they can be counted, and search
+                # them separately
+                complete = [k for k, c in splits.items() if sum(c.values()) == found]
+                partial = [k for k, c in splits.items() if sum(c.values()) < found]
+                if not (complete or partial):
+                    leaves.append(constraints)
+                    continue
+                facet = min(complete or partial, key=lambda k: max(splits[k].values()))
+                for value, n in splits[facet].items():
+                    sub = dict(constraints)
+                    sub[facet] = (value,)
+                    if n <= limit:
+                        leaves.append(sub)
+                    else:
+                        next_frontier.append((sub, None, None))
+                rest = found - sum(splits[facet].values())
+                if rest > 0:
+                    # search the remaining results excluding the split values
+                    sub = dict(constraints)
+                    sub[facet + '!'] = tuple(splits[facet])
+                    next_frontier.append((sub, rest, constraints))
+            frontier = next_frontier
+            results = executor.map(count, [c for c, _, _ in frontier])
+
+    seen = set()
+    for doc in _concurrent_docs(query, fields, leaves, workers=workers, limit=limit):
+        if doc['id'] not in seen:
+            seen.add(doc['id'])
+            yield doc
+
+
 def link_to_esgf(query, **kwargs):
     """Convert search terms to a ESGF search URL
 
@@ -142,18 +684,39 @@ def link_to_esgf(query, **kwargs):
     return r.prepare().url
 
 
-def find_checksum_id(query, **kwargs):
+def _checksum_type(doc):
+    """Return the lower case checksum type of an ESGF document, or None if
+    not one of the types stored in :class:`clef.model.Checksum`
+    """
+    ctype = doc.get('checksum_type', [None])
+    if isinstance(ctype, list):
+        ctype = ctype[0] if len(ctype) > 0 else None
+    if ctype is not None and ctype.lower() in ('md5', 'sha256'):
+        return ctype.lower()
+    return None
+
+
+def find_checksum_id(query, stream=False, split=False, datasets=None, **kwargs):
     """Get checksums and IDs of matching files from ESGF
 
-    Searches ESGF using :func:`esgf_query`, then converts the response into a
-    SQLAlchemy selectable for further processing
+    Searches ESGF using :func:`esgf_docs`, then converts the response into a
+    SQLAlchemy selectable for further processing. All the result pages are
+    retrieved, so there is no limit on the number of files returned.
 
     Args:
+        stream (bool): Decode the ESGF responses incrementally, so only the
+            matching table is kept in memory
+        split (bool): Split searches with more results than `limit` along
+            the ESGF facets using :func:`split_docs`
+        datasets (list): Only return the files of these ESGF dataset ids
+            (see :func:`match_datasets`), searched concurrently in batches
+            of :data:`max_dataset_constraint`. The batches are never split
         **kwargs: See :func:`esgf_query`
 
     Returns:
         Values table of matching File objects, containing
          * checksum
+         * checksum_type ('md5', 'sha256' or None if unknown)
          * id
          * dataset_id
          * title
@@ -161,18 +724,23 @@ def find_checksum_id(query, **kwargs):
         This table can be joined against the DB database tables
     """
     constraints = {k: v for k,v in kwargs.items() if v != ()}
-    response = esgf_query(query, 'checksum,id,dataset_id,title,version', **constraints)
-
-    if response['response']['numFound'] == 0:
-        raise ESGFException('No matches found on ESGF, check at %s'%link_to_esgf(query, **constraints))
-
-    if response['response']['numFound'] > int(response['responseHeader']['params']['rows']):
-        raise ESGFException('Too many results (%d), try limiting your search %s'%(response['response']['numFound'], 
-                            link_to_esgf(query, **constraints)))
-    # separate records that do not have checksum in response (nosums list) from others (records list)
-    # we should call local_search for these i.e. a search not based on checksums but is not yet implemented
-    nosums=[]
-    records=[]
+    fields = 'checksum,checksum_type,id,dataset_id,title,version'
+    keep = None
+    searches = [constraints]
+    if datasets is not None:
+        keep = set(d.split('|')[0] for d in datasets)
+        # the datasets are requested in batches, to keep the url length reasonable
+        datasets = list(datasets)
+        searches = [dict(constraints, dataset_id=tuple(datasets[i:i+max_dataset_constraint]))
+                    for i in range(0, len(datasets), max_dataset_constraint)]
+    if datasets is not None:
+        # each batch is already bounded by its dataset ids, so they are not
+        # split but searched concurrently
+        docs = _concurrent_docs(query, fields, searches, stream=stream)
+    elif split:
+        docs = split_docs(query, fields, **constraints)
+    else:
+        docs = esgf_docs(query, fields, stream=stream, **constraints)
     # another issue appears when latest=False, then the ESGF return in the response all the variables in same dataset-id, this happens with CMIP5
     no_filter = True
     if ( constraints.get('project', None) == 'CMIP5' and constraints.get('latest', None) is False 
@@ -180,54 +748,145 @@ def find_checksum_id(query, **kwargs):
         matches_list = ['.'+var+'_' for var in constraints.get('variable', []) ]
         no_filter = False
 
-    for doc in response['response']['docs']:
+    # separate records that do not have checksum in response (nosums list) from others (records list)
+    # we should call local_search for these i.e. a search not based on checksums but is not yet implemented
+    # each document is reduced to a tuple as soon as it is received
+    record_list = []
+    nosums_list = []
+    for doc in docs:
+        if keep is not None and doc['dataset_id'].split('|')[0] not in keep:
+            continue
         if  no_filter or any(st in doc['id'] for st in matches_list):
-            if 'checksum' in doc.keys():
-                records.append(doc)
+            file_id = doc['id'].split('|')[0] # drop the server name
+            if 'checksum' in doc:
+                record_list.append((doc['checksum'][0],
+                    _checksum_type(doc),
+                    file_id,
+                    doc['dataset_id'].split('|')[0], # Drop the server name
+                    doc['title'],
+                    doc['version'],
+                    doc['score']))
             else:
-                nosums.append(doc)
-     
-    record_list = [ 
-             (doc['checksum'][0],
-              doc['id'].split('|')[0], # drop the server name
-              doc['dataset_id'].split('|')[0], # Drop the server name
-              doc['title'],
-              doc['version'],
-              doc['score'])
-            for doc in records]
-    nosums_list = [ 
-             ('NA',
-              doc['id'].split('|')[0], # drop the server name
-              doc['id'].split('|')[0], # Drop the server name
-              doc['title'],
-              doc['version'],
-              doc['score'])
-            for doc in nosums]
-    table = sqlalvalues(
-            column('checksum', String),
-            column('id', String),
-            column('dataset_id', String),
-            column('title', String),
-            column('version', Integer),
-            column('score', Float),
-            name = 'esgf_table'
-        ).data(record_list)
-    nocksum = False
-    if record_list == []:
-        table = sqlalvalues(
-            column('checksum', String),
-            column('id', String),
-            column('dataset_id', String),
-            column('title', String),
-            column('version', Integer),
-            column('score', Float),
-            name = 'esgf_table'
-          ).data(nosums_list)
-        nocksum = True
+                nosums_list.append(('NA',
+                    None,
+                    file_id,
+                    file_id,
+                    doc['title'],
+                    doc['version'],
+                    doc['score']))
+    if record_list == [] and nosums_list == []:
+        raise ESGFException('No matches found on ESGF, check at %s'%link_to_esgf(query, **constraints))
+    columns = [column('checksum', String),
+               column('checksum_type', String),
+               column('id', String),
+               column('dataset_id', String),
+               column('title', String),
+               column('version', Integer),
+               column('score', Float)]
+    nocksum = record_list == []
+    table = array_values(columns, nosums_list if nocksum else record_list, name='esgf_table')
 
     return table, nocksum
 
 
+#: ESGF facets identifying a dataset, and the corresponding local columns.
+#: Only projects listed here are matched by :func:`match_datasets`
+dataset_facets = {
+        'CMIP6': {
+            'source_id': C6Dataset.source_id,
+            'experiment_id': C6Dataset.experiment_id,
+            'member_id': C6Dataset.member_id,
+            'table_id': C6Dataset.table_id,
+            'variable_id': C6Dataset.variable_id,
+            'grid_label': C6Dataset.grid_label,
+            },
+        }
+
+#: Maximum number of dataset ids sent as a constraint to ESGF by
+#: :func:`find_checksum_id`
+max_dataset_constraint = 50
+
+
+def local_dataset_index(session, project, values):
+    """Count the local files of each dataset version in each directory
+
+    Args:
+        project (str): Project, a key of :data:`dataset_facets`
+        values (dict): Facet values to restrict the search, {facet: set(values)}
+
+    Returns:
+        dict: {(facet values..., version): [(number of files, directory), ...]}
+    """
+    facets = dataset_facets[project]
+    cols = [facets[f] for f in facets]
+    # the version is taken from the path if not in the extended metadata
+    version = version_key_sql(ExtendedMetadata.version, Path.path)
+    directory = func.regexp_replace(Path.path, '[^//]*$', '')
+    q = (session.query(*cols, version, directory, func.count(Path.id.distinct()))
+            .select_from(Path)
+            .join(Path.c6dataset)
+            .outerjoin(Path.extended)
+            .filter(_publication_filter(Path.path))
+            .filter(*[facets[f].in_(sorted(values[f])) for f in facets])
+            .group_by(*cols, version, directory))
+    index = {}
+    for row in q:
+        index.setdefault(tuple(row[:-2]), []).append((row[-1], row[-2]))
+    return index
+
+
+def match_datasets(session, query, project, **kwargs):
+    """Match whole ESGF datasets against the local datasets
+
+    Searches ESGF for datasets, then compares their number of files with the
+    number of local files of the same dataset and version in each local
+    directory. Datasets that have a complete local directory do not need to
+    be matched file by file, and only that directory is returned.
+
+    Args:
+        project (str): Project, a key of :data:`dataset_facets`
+        **kwargs: See :func:`esgf_query`
+
+    Returns:
+        A tuple (paths, pending), paths are the local directories of the complete
+        datasets, pending the ESGF ids of the datasets missing or incomplete
+        locally, or None if the ESGF results could not be compared and all the
+        files need to be matched
+    """
+    facets = list(dataset_facets[project])
+    constraints = {k: v for k,v in kwargs.items() if v != ()}
+    fields = ','.join(['id', 'version', 'number_of_files'] + facets)
+    docs = esgf_docs(query, fields, otype='Dataset', project=project, **constraints)
+
+    datasets = []
+    values = {f: set() for f in facets}
+    for doc in docs:
+        try:
+            key = tuple(doc[f][0] if isinstance(doc[f], list) else doc[f] for f in facets)
+            key += (version_digits(doc['version']),)
+            nfiles = int(doc['number_of_files'])
+        except (KeyError, IndexError, TypeError, ValueError):
+            return [], None
+        datasets.append((doc['id'], key, nfiles))
+        for f, v in zip(facets, key):
+            values[f].add(v)
+
+    if len(datasets) == 0:
+        raise ESGFException('No matches found on ESGF, check at %s'%link_to_esgf(query, project=project, **constraints))
+
+    index = local_dataset_index(session, project, values)
+    paths = set()
+    pending = []
+    for did, key, nfiles in datasets:
+        # partial copies in different directories don't make a complete dataset
+        complete = sorted(d for n, d in index.get(key, []) if n >= nfiles)
+        if complete:
+            paths.add(complete[0])
+        else:
+            pending.append(did)
+    return sorted(paths), pending
+
+
 def match_query(session, query, latest=None, **kwargs):
     """Match ESGF results against :class:`clef.model.Path`
 
@@ -242,17 +901,31 @@ def match_query(session, query, latest=None, **kwargs):
         **kwargs: See :func:`esgf_query`
 
     Returns:
-        Joined result of :class:`clef.model.Path` and :func:`find_checksum_id`
+        Joined result of :class:`clef.model.Path` and :func:`find_checksum_id`,
+        with the path columns labelled 'esgf_paths_path' and 'esgf_paths_file_id'
     """
     checksum_table, nocksum = find_checksum_id(query, latest=latest, **kwargs)
 
     if latest is True:
-        # Exact match on checksum
-        matches = (checksum_table
-                .outerjoin(Checksum,
-                    or_(Checksum.md5 == checksum_table.c.checksum,
-                        Checksum.sha256 == checksum_table.c.checksum))
-                .outerjoin(Path))
+        # Exact match on checksum, each checksum type is joined separately so
+        # that the checksum indexes can be used, files with an unknown checksum
+        # type are compared with both. The ESGF arrays are unnested once in a
+        # CTE read by all the branches, so they are sent only once
+        esgf = sa.select(checksum_table).cte('esgf_values')
+        ctype = esgf.c.checksum_type
+        branches = [
+            (Checksum.md5 == esgf.c.checksum, ctype == 'md5'),
+            (Checksum.sha256 == esgf.c.checksum, ctype == 'sha256'),
+            (or_(Checksum.md5 == esgf.c.checksum,
+                 Checksum.sha256 == esgf.c.checksum), ctype == None),
+            ]
+        matches = sa.union_all(*[
+            sa.select(esgf,
+                      Path.id.label('esgf_paths_file_id'),
+                      Path.path.label('esgf_paths_path'))
+                .select_from(esgf.outerjoin(Checksum, on).outerjoin(Path))
+                .where(where)
+            for on, where in branches]).subquery('esgf_matches')
     else:
         # Match on file name
         matches = checksum_table.join(Path, func.regexp_replace(Path.path, '^.*/', '') == checksum_table.c.title)
@@ -280,16 +953,77 @@ def find_local_path(session, subq):
             .query(func.regexp_replace(subq.c.esgf_paths_path, '[^//]*$', ''))
             .select_from(subq)
             .filter(subq.c.esgf_paths_file_id != None)
-            .filter(sa.not_(sa.and_(
-                subq.c.esgf_paths_path.like('/g/data/rr3/publications/CMIP5/%'),
-                sa.not_(subq.c.esgf_paths_path.like('/g/data/rr3/publications/CMIP5/%/files/%')))))
-            .filter(sa.not_(sa.and_(
-                subq.c.esgf_paths_path.like('/g/data/fs38/publications/CMIP6/%'),
-                sa.not_(subq.c.esgf_paths_path.like('/g/data/fs38/publications/CMIP6/%/files/%'))
-            )))
+            .filter(_publication_filter(subq.c.esgf_paths_path))
             .distinct())
 
 
+def _publication_filter(path):
+    """Filter out the duplicate publication paths, keeping only the ones
+    under 'files/'
+    """
+    return sa.and_(
+            sa.not_(sa.and_(
+                path.like('/g/data/rr3/publications/CMIP5/%'),
+                sa.not_(path.like('/g/data/rr3/publications/CMIP5/%/files/%')))),
+            sa.not_(sa.and_(
+                path.like('/g/data/fs38/publications/CMIP6/%'),
+                sa.not_(path.like('/g/data/fs38/publications/CMIP6/%/files/%')))))
+
+
+def find_local_missing(session, subq):
+    """Find both the local paths and the missing ids of ESGF matches
+
+    Combines :func:`find_local_path` and :func:`find_missing_id` in a single
+    query, so that the ESGF results are sent to the database only once
+
+    Args:
+        subq: result of func:`match_query`
+
+    Returns:
+        A tuple (paths, missing), paths is a list of the local directories,
+        missing a list of rows with the ESGF dataset id of the missing files
+    """
+    paths = []
+    missing = []
+    for is_local, value in _local_missing_query(session, subq).distinct():
+        if is_local:
+            paths.append(value)
+        else:
+            missing.append((value,))
+    return paths, missing
+
+
+def stream_local_missing(session, subq, batch=1000):
+    """Generator version of :func:`find_local_missing`
+
+    The results are read with a server-side cursor, ordered so that all the
+    local directories come first, then the missing ids. Values are not
+    de-duplicated. Only the database results are streamed, subq already
+    holds all the ESGF documents, so nothing is returned before the whole
+    ESGF search has been read.
+
+    Args:
+        subq: result of func:`match_query`
+        batch (int): number of rows fetched at a time
+
+    Returns:
+        Iterable of tuples (True, local directory) or (False, missing dataset id)
+    """
+    q = _local_missing_query(session, subq)
+    local, value = [c['expr'] for c in q.column_descriptions]
+    return q.order_by(local.desc(), value).yield_per(batch)
+
+
+def _local_missing_query(session, subq):
+    local = subq.c.esgf_paths_file_id != None
+    return (session
+            .query(local,
+                   sa.case((local, func.regexp_replace(subq.c.esgf_paths_path, '[^//]*$', '')),
+                           else_=column('dataset_id')))
+            .select_from(subq)
+            .filter(or_(sa.not_(local), _publication_filter(subq.c.esgf_paths_path))))
+
+
 def find_missing_id(session, subq):
     """
     Returns the ESGF id for each file in the ESGF query that doesn't have a
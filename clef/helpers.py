@@ -15,17 +15,27 @@
 # limitations under the License.
 
 
-import json
 import re
-import pkg_resources
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+import click
 
 from calendar import monthrange
+from collections.abc import Sequence
 from datetime import datetime, timedelta
 
 from .exception import ClefException
+from .drs import build_ids
+from . import vocab
 #from .cordex import get_esgf_facets
 
 
+#: Regular expression of the dataset version in a path, used when the version
+#: is not stored in the database
+version_pattern = r'\d{8}'
+
+
 def get_version(path):
     """Retrieve version from path if not available in local database 
 
@@ -36,13 +46,38 @@ def get_version(path):
         string of version extracted from path or None
 
     """
-    mo = re.search(r'\d{8}', path)
+    mo = re.search(version_pattern, path)
     if mo:
         return  "v" + mo.group()
     else:
         return  'NA' 
 
 
+def version_digits(version):
+    """Normalise a dataset version to its digits, so versions with and without
+    the 'v' prefix can be compared
+
+    >>> version_digits('v20190627'), version_digits(20190627)
+    ('20190627', '20190627')
+    """
+    return re.sub(r'^v', '', str(version))
+
+
+def version_key_sql(version, path):
+    """SQL version of :func:`version_digits`, taking the version from the
+    path with :data:`version_pattern` as :func:`get_version` if it is null
+
+    Args:
+        version: version column
+        path: path column
+
+    Returns:
+        SQL expression of the version digits
+    """
+    return sa.func.coalesce(sa.func.regexp_replace(version, '^v', ''),
+                            sa.func.substring(path, version_pattern))
+
+
 def get_member(path):
     """Retrieve member_id from path ifpotentially wrong in database
 
@@ -140,6 +175,125 @@ def time_axis(periods,fdate,tdate):
     return contiguos
 
 
+#: Days in each month of a year without leap day
+_month_days = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+def _month_length(year, month):
+    """Number of days in each month, for arrays of years and months
+    """
+    days = _month_days[np.clip(month, 1, 12) - 1]
+    leap = ((year % 4 == 0) & (year % 100 != 0)) | (year % 400 == 0)
+    return days + ((month == 2) & leap)
+
+
+def _day_number(date):
+    """Convert an array of YYYYMMDD integers to days since a reference date
+
+    Dates are in the proleptic gregorian calendar, as with :mod:`datetime` in
+    :func:`time_axis`
+
+    Returns:
+        days, valid (numpy arrays): day numbers and if each date is valid
+    """
+    y, m, d = date // 10000, date // 100 % 100, date % 100
+    valid = (m >= 1) & (m <= 12) & (d >= 1) & (d <= _month_length(y, m)) & (y >= 1)
+    # counting years from March so leap days are last
+    y = y - (m <= 2)
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * ((m + 9) % 12) + 2) // 5 + d - 1
+    days = era * 146097 + yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return days, valid
+
+
+def period_stats(ranges):
+    """Vectorised version of convert_periods, get_range and time_axis for many datasets
+
+    All the file periods are converted to flat integer arrays, with monthly
+    periods expanded to the first and last day of the month, and the
+    contiguity of the time axis is checked with day numbers instead of dates.
+    Datasets with periods that are not monthly or daily are processed with the
+    scalar functions instead.
+
+    >>> from psycopg2.extras import NumericRange
+    >>> period_stats([[NumericRange(200001, 200013), NumericRange(200101, 200113)]])
+    ([[('20000101', '20001231'), ('20010101', '20011231')]], ['20000101'], ['20011231'], [True])
+
+    Args:
+        ranges (list): for each dataset a list of NumericRange file periods
+
+    Returns:
+        periods, fdate, tdate, time_complete (lists): with one element for each
+        dataset, as returned by convert_periods, get_range and time_axis
+    """
+    n = len(ranges)
+    lowers, uppers, counts = [], [], []
+    scalar = np.zeros(n, dtype=bool)
+    for i, rs in enumerate(ranges):
+        rs = [r for r in rs if r is not None]
+        if any(r.lower is None or r.upper is None for r in rs):
+            scalar[i] = True
+            rs = []
+        lowers.extend(r.lower for r in rs)
+        uppers.extend(r.upper - 1 for r in rs)
+        counts.append(len(rs))
+    lo = np.array(lowers, dtype=np.int64)
+    hi = np.array(uppers, dtype=np.int64)
+    counts = np.array(counts, dtype=np.int64)
+    ds = np.repeat(np.arange(n), counts)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    # expand monthly periods to days, anything else than YYYYMM or YYYYMMDD
+    # is left to the scalar functions
+    monthly = (lo >= 10**5) & (lo < 10**6)
+    daily = (lo >= 10**7) & (lo < 10**8)
+    ok = daily & (hi >= 10**7) & (hi < 10**8)
+    ok |= monthly & (hi >= 10**5) & (hi < 10**6) & (hi % 100 >= 1) & (hi % 100 <= 12)
+    scalar |= np.bincount(ds[~ok], minlength=n) > 0
+    mdays = _month_length(hi // 100, hi % 100)
+    lo = np.where(monthly, lo * 100 + 1, lo)
+    hi = np.where(monthly, hi * 100 + mdays, hi)
+
+    slo = lo.astype(str).tolist()
+    shi = hi.astype(str).tolist()
+    periods = [list(zip(slo[a:b], shi[a:b])) for a, b in zip(offsets[:-1], offsets[1:])]
+    fdate = [None] * n
+    tdate = [None] * n
+    complete = [None] * n
+
+    keep = ~scalar[ds]
+    if keep.any():
+        d, l, h = ds[keep], lo[keep], hi[keep]
+        order = np.lexsort((h, l, d))
+        d, l, h = d[order], l[order], h[order]
+        first = np.concatenate([[True], d[1:] != d[:-1]])
+        starts = np.flatnonzero(first)
+        tmax = np.maximum.reduceat(h, starts)
+
+        dl, vl = _day_number(l)
+        dh, vh = _day_number(h)
+        # a file follows the previous one if it starts the day after it ends,
+        # the first file always starts on the from date
+        follows = first | np.concatenate([[False], vl[1:] & (dl[1:] == dh[:-1] + 1)])
+        # time_axis stops at the first file not following, or ending on an invalid date
+        status = np.where(~follows, 1, np.where(~vh, 2, 0))
+        pos = np.where(status > 0, np.arange(len(status)), len(status))
+        stop = np.minimum.reduceat(pos, starts)
+        for k, i in enumerate(d[starts]):
+            fdate[i], tdate[i] = str(l[starts[k]]), str(tmax[k])
+            if stop[k] == len(status):
+                complete[i] = True
+            else:
+                complete[i] = False if status[stop[k]] == 1 else None
+
+    for i in np.flatnonzero(scalar):
+        periods[i] = convert_periods(ranges[i])
+        fdate[i], tdate[i] = get_range(periods[i])
+        complete[i] = time_axis(periods[i], fdate[i], tdate[i])
+    return periods, fdate, tdate, complete
+
+
 def get_keys(project):
     """Define valid arguments keys based on project
 
@@ -153,14 +307,11 @@ def get_keys(project):
     # valid_keys.json is a dictionary where the keys are tuple of all valid arguments
     # and the values represent the corresponding facet for CMIP5 and CMIP6
     # ex. ('variable', 'variable_id', 'v'): {'CMIP5': 'variable', 'CMIP6': 'variable_id'}
-    fkeys = pkg_resources.resource_filename(__name__, 'data/valid_keys.json')
-    with open(fkeys, 'r') as f:
-         data = json.loads(f.read())
     try:
-        valid_keys = {v[project]: k.split(":") for k,v in data.items() if v[project] != 'NA'}
-    except KeyError:
+        keys = vocab.valid_keys(project)
+    except ClefException:
         raise ClefException(f"Keys validation not defined for project: {project}")
-    return valid_keys
+    return {k: list(v) for k,v in keys.items()}
 
 
 def get_facets(project):
@@ -173,21 +324,10 @@ def get_facets(project):
         facets (dictionary): project facets
 
     """
-    project = project.upper()
-    facets =  {'CMIP6': {}, 'CMIP5': {}, 'CORDEX': {}}
-    ffacets = pkg_resources.resource_filename(__name__, 'data/facets.json')
-    with open(ffacets, 'r') as f:
-         data = json.loads(f.read()) 
     try:
-        new_keys = ['mip','pr', 'e', 'f', 'gr', 'inst', 'era', 'res',  'prod',
-                    'r', 'm', 'mtype', 'se', 't', 'v', 'vl', 'en', 'ef', 'cf', 
-                    'd', 'rcmv', 'vrs', 'dex', 'dmod']
-        facets['CMIP6'] = {k:v for k,v in zip(new_keys, [x[0] for x in data.values()])}
-        facets['CMIP5'] = {k:v for k,v in zip(new_keys, [x[1] for x in data.values()])}
-        facets['CORDEX'] = {k:v for k,v in zip(new_keys, [x[2] for x in data.values()])}
-    except KeyError:
+        return dict(vocab.facet_names(project))
+    except ClefException:
         raise ClefException(f"Keys validation not defined for project: {project}")
-    return facets[project]
 
 
 def check_keys(valid_keys, kwargs):
@@ -203,15 +343,18 @@ def check_keys(valid_keys, kwargs):
     """ 
     # load dictionary to check arguments keys are valid
     # rewrite kwargs with the right facet name
+    aliases = {}
+    for facet, names in valid_keys.items():
+        for n in names:
+            aliases.setdefault(n, facet)
     args = {}
     for key,value in kwargs.items():
-        facets = [k for k,v in valid_keys.items() if key in v]
-        if facets==[]:
+        if key not in aliases:
             raise ClefException(
                 f"Warning {key} is not a valid constraint name"
                 f"Valid constraints are:\n{valid_keys.values()}")
         else:
-            args[facets[0]] = value
+            args[aliases[key]] = value
     return args
 
 
@@ -219,21 +362,27 @@ def check_values(args, project, vocabularies):
     """Check that arguments values passed to search are valid, if not print warning and exit
 
     Args:
-        args (dict): query constraints
+        args (dict): query constraints, each with one or a list of values
         project (str): data project
-        vocabularies (dict of lists): {facet: valid values}
+        vocabularies (dict): {facet: valid values}, sets are checked without
+            conversion, see :func:`clef.vocab.value_sets`
 
     Returns:
 
     """
     if project not in ['CMIP5', 'CMIP6', 'CORDEX']:
         raise ClefException(f'Query for {project} not yet implemented')
-    facets = [v for v in get_facets(project).values() if v is not None]
+    facets = vocab.facet_names(project).values()
     for k,v in args.items():
-        if k not in facets:
+        if k is None or k not in facets:
             raise ClefException(f'"{k}" is not a valid facet for project {project}')
-        elif k in vocabularies.keys() and v not in vocabularies[k]:
-            raise ClefException(f'"{v}" is not a valid value for the facet "{k}" in project {project}')
+        elif k in vocabularies.keys():
+            valid = vocabularies[k]
+            if not isinstance(valid, (set, frozenset)):
+                valid = set(valid)
+            for x in (v if isinstance(v, (list, tuple, set)) else [v]):
+                if x not in valid:
+                    raise ClefException(f'"{x}" is not a valid value for the facet "{k}" in project {project}')
     return True
 
 
@@ -241,25 +390,16 @@ def load_vocabularies(project):
     """Load project vocabularies from json file.
 
     Load from project json data files all accepted values for facets.
+    The values are read once from the compiled store, see :mod:`clef.vocab`
 
     Args:
         project (str): data project
 
     Returns:
-        a series of lists (list): one for each facets, elements are accepted values 
+        a series of lists (dict): one for each facets, elements are accepted values 
 
     """
-    project = project.upper()
-    if project.split('-')[0] == 'CORDEX':
-        project = 'CORDEX'
-        #vocab = get_esgf_facets('CORDEX')
-        #vocab['frequency'] = vocab['time_frequency']
-        #vocab['attributes'] = [k for k in vocab.keys()]
-    vfile = pkg_resources.resource_filename(__name__, 'data/'+project+'_validation.json')
-    with open(vfile, 'r') as f:
-        data = f.read()
-        vocab = json.loads(data)
-    return vocab
+    return {k: list(v) for k, v in vocab.vocabulary(project).items()}
 
 
 def fix_model(project, models, invert=False):
@@ -278,16 +418,104 @@ def fix_model(project, models, invert=False):
         invert (bool): Invert the conversion (so go from ``CESM1(BGC)`` to ``CESM1-BGC``)
 
     """
-    project = project.upper().split('-')[0]
-    if project  in ['CMIP5', 'CORDEX']:
-        mfile = pkg_resources.resource_filename(__name__, 'data/'+project+'_model_fix.json')
-        with open(mfile, 'r') as f:
-            mdict = json.loads(f.read())
-        if invert:
-            mfix = {v: k for k, v in mdict.items()}
-        else:
-            mfix = mdict
-    return  [mfix[m] if m in mfix.keys() else m for m in models]
+    mfix = vocab.model_fix(project, invert)
+    return  [mfix.get(m, m) for m in models]
+
+
+class VocabValues(Sequence):
+    """Accepted values of a project facet, read from :mod:`clef.vocab` when
+    first used
+
+    Args:
+        project (str): data project
+        facet (str): facet name
+        extra (list): other accepted values
+    """
+
+    def __init__(self, project, facet, extra=()):
+        self.project = project
+        self.facet = facet
+        self.extra = tuple(extra)
+
+    def _values(self):
+        return vocab.vocabulary(self.project)[self.facet] + self.extra
+
+    def __getitem__(self, i):
+        return self._values()[i]
+
+    def __len__(self):
+        return len(self._values())
+
+    def __contains__(self, value):
+        return value in vocab.value_sets(self.project)[self.facet] or value in self.extra
+
+
+class VocabChoice(click.Choice):
+    """click.Choice of the accepted values of a project facet
+
+    The choices are a :class:`VocabValues`, so the values are read when first
+    needed. Click versions that copy the choices to a tuple read them when the
+    option is created, which is a single load of the store. Values are
+    checked with a set lookup before falling back to click normalisation
+
+    Args:
+        project (str): data project
+        facet (str): facet name
+        extra (list): other accepted values
+        case_sensitive (bool): see click.Choice
+    """
+
+    def __init__(self, project, facet, extra=(), case_sensitive=True):
+        self.project = project
+        self.facet = facet
+        self.extra = tuple(extra)
+        super().__init__(VocabValues(project, facet, extra), case_sensitive)
+
+    def convert(self, value, param, ctx):
+        if ((ctx is None or ctx.token_normalize_func is None) and
+            (value in vocab.value_sets(self.project)[self.facet] or value in self.extra)):
+            return value
+        return super().convert(value, param, ctx)
+
+
+#: Rules used by :func:`fix_path` to convert paths to the directories shown to users.
+#: The first rule whose `contains` substrings are all in the path and `excludes`
+#: substrings are not is applied, rules with `latest` only when searching the latest versions.
+#: `pattern` is replaced by `repl` in the path, all matches if `all` is True. Rules
+#: with `translate` are skipped if the pattern doesn't match. `translate` (group,
+#: from, to) replaces the characters of from with those of to in a group of the
+#: match, as :meth:`str.translate`, for patterns that match the whole path.
+path_rules = [
+    # al33 output1/2 dirs to combined
+    {'contains': ['/al33/replicas/CMIP5/output'],
+     'pattern': r'replicas/CMIP5/output[12]?/', 'repl': 'replicas/CMIP5/combined/', 'all': True},
+    {'contains': ['/al33/replicas/CMIP5/unsolicited'],
+     'pattern': r'unsolicited', 'repl': 'combined', 'all': True},
+    # rr3 ACCESS "/files/<var>_<date>/" path to "/latest/<var>/"
+    {'contains': ['/rr3/publications/CMIP5/output1/CSIRO-BOM'], 'latest': True,
+     'pattern': r'^(.*)/[^/]*/([^/_]*)[^/]*/([^/]*)$', 'repl': r'\1/latest/\2/\3'},
+    # added to eliminate wrong paths for mk3.6.0 once that is fixed might be removed
+    {'contains': ['/rr3/publications/CMIP5/output1/CSIRO-QCCCE'], 'excludes': ['files'],
+     'pattern': r'^.*$', 'repl': '/path/todelete/'},
+    # fs38 "/files/d<date>/" to "/v<date>/", every 'd' of the directory is replaced
+    {'contains': ['/fs38/publications/CMIP6/', '/d20'],
+     'pattern': r'^(.*)/[^/]*/([^/]*)/[^/]*$', 'repl': r'\1/\2/', 'translate': (2, 'd', 'v')},
+    # rr3 CORDEX version dir to "latest"
+    {'contains': ['/rr3/publications/CORDEX', '/files/'], 'latest': True,
+     'pattern': r'^(.*)/[^/]*/[^/]*/[^/]*$', 'repl': r'\1/latest/'},
+    {'contains': ['/rr3/publications/CORDEX'], 'latest': True,
+     'pattern': r'^(.*)/[^/]*/[^/]*$', 'repl': r'\1/latest/'},
+    ]
+
+_compiled_rules = [(r, re.compile(r['pattern'])) for r in path_rules]
+
+_backref = re.compile(r'\\(\d)')
+
+
+def _path_rules(latest):
+    """Return the rules that apply to a search of latest or all versions
+    """
+    return [(r, regex) for r, regex in _compiled_rules if latest or not r.get('latest', False)]
 
 
 def fix_path(path, latest):
@@ -297,47 +525,101 @@ def fix_path(path, latest):
        - rr3 Mk3.6 remove version dir leaves  files
        - fs38 replace d+date with v+date
 
+    The replacements are defined in :data:`path_rules`
+
     Args:
+        path (str): file or directory path, directories should end with '/'
+        latest (bool): the search is for the latest versions only
 
+    Returns:
+        path (str): the fixed path
     """
-    if '/al33/replicas/CMIP5/output' in path:
-        return re.sub(r'replicas\/CMIP5\/output[12]?\/','replicas/CMIP5/combined/',path)
-    elif '/al33/replicas/CMIP5/unsolicited' in path:
-        return path.replace('unsolicited','combined')
-    elif '/rr3/publications/CMIP5/output1/CSIRO-BOM' in path and latest:
-        dirs=path.split("/")
-        var = dirs[-2].split("_")[0]
-        return "/".join(dirs[0:-3]+['latest',var,dirs[-1]])
-    # added to eliminate wrong paths for mk3.6.0 once that is fixed might be removed
-    elif '/rr3/publications/CMIP5/output1/CSIRO-QCCCE' in path and 'files' not in path:
-        return '/path/todelete/' 
-    elif '/fs38/publications/CMIP6/' in path and '/d20' in path:
-        dirs=path.split("/")
-        vdir = dirs[-2].replace('d','v')
-        return "/".join(dirs[:-3]+[vdir, ""])
-    elif '/rr3/publications/CORDEX' in path and latest:
-        dirs=path.split("/")
-        n = -2
-        if '/files/' in path:
-            n = -3
-        return "/".join(dirs[0:n]+['latest/'])
-    else:
-        return path
+    for rule, regex in _path_rules(latest):
+        if (all(s in path for s in rule['contains'])
+                and not any(s in path for s in rule.get('excludes', []))
+                and not ('translate' in rule and regex.search(path) is None)):
+            if 'translate' in rule:
+                return _translate_sub(rule, regex, path)
+            return regex.sub(rule['repl'], path, count=0 if rule.get('all') else 1)
+    return path
+
+
+def _translate_sub(rule, regex, path):
+    """Apply a rule with `translate`, see :data:`path_rules`
+    """
+    m = regex.search(path)
+    n, old, new = rule['translate']
+    groups = [m.group(0)] + [g or '' for g in m.groups()]
+    groups[n] = groups[n].translate(str.maketrans(old, new))
+    return path[:m.start()] + _backref.sub(lambda b: groups[int(b.group(1))], rule['repl']) + path[m.end():]
+
+
+def fix_dirs(dirs, latest):
+    """Apply :func:`fix_path` to a list of directories, fixing each distinct
+    directory only once
+
+    Args:
+        dirs (list): directory paths, ending with '/'
+        latest (bool): the search is for the latest versions only
+
+    Returns:
+        list of the fixed directories
+    """
+    fixed = {d: fix_path(d, latest) for d in set(dirs)}
+    return [fixed[d] for d in dirs]
+
+
+def fix_path_sql(path, latest):
+    """SQL expression applying :func:`fix_path` to a path column
+
+    Args:
+        path: SQLAlchemy column or expression
+        latest (bool): the search is for the latest versions only
+
+    Returns:
+        SQLAlchemy expression
+    """
+    whens = []
+    for rule, regex in _path_rules(latest):
+        cond = sa.and_(*[path.contains(s, autoescape=True) for s in rule['contains']],
+                       *[sa.not_(path.contains(s, autoescape=True)) for s in rule.get('excludes', [])])
+        if 'translate' in rule:
+            cond = sa.and_(cond, path.regexp_match(rule['pattern']))
+            whens.append((cond, _translate_sql(rule, path)))
+            continue
+        flags = 'g' if rule.get('all') else ''
+        whens.append((cond, sa.func.regexp_replace(path, rule['pattern'], rule['repl'], flags)))
+    return sa.case(*whens, else_=path)
+
+
+def _translate_sql(rule, path):
+    """SQL version of :func:`_translate_sub`, the pattern matches the whole path
+    so each group is extracted by replacing the path with it
+    """
+    n, old, new = rule['translate']
+    parts = _backref.split(rule['repl'])
+    expr = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            if part:
+                expr.append(sa.literal(part))
+            continue
+        group = sa.func.regexp_replace(path, rule['pattern'], '\\' + part)
+        expr.append(sa.func.translate(group, old, new) if int(part) == n else group)
+    return sa.func.concat(*expr)
 
 
 def get_id(r):
     ''' Build dataset_id for CMIP6 starting from dataframe row
     '''
     # CMIP6.ScenarioMIP.MIROC.MIROC6.ssp585.r1i1p1f1.Amon.pr.gn.v20190627
-    version = r.version if not None else 'none'
-    return '.'.join(['CMIP6', r.activity_id, r.institution_id, r.source_id, r.experiment_id,
-                     r.member_id, r.table_id, r.variable_id, r.grid_label, version])
+    return get_ids(pd.DataFrame([r]))[0]
 
 def get_ids(df):
     ''' Build dataset_id starting from dataframe
-        Calls get_id for each row
+        Joins the CMIP6 facet columns, see :func:`clef.drs.build_ids`
     '''
     if 'dataset_id' in df.columns:
         return df['dataset_id'].to_list()
     else:
-        return df.apply(get_id, axis=1).to_list() 
+        return build_ids(df.drop(columns='project', errors='ignore'), 'CMIP6')
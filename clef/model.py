@@ -36,7 +36,7 @@ group paths on the filesystem into datasets.
 
 
 from sqlalchemy import Column, ForeignKey, Text, Integer, String, Table
-from sqlalchemy.dialects.postgresql import UUID, JSONB, INT4RANGE
+from sqlalchemy.dialects.postgresql import UUID, JSONB, INT4RANGE, ARRAY
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.indexable import index_property
 from sqlalchemy.orm import relationship, column_property
@@ -235,6 +235,9 @@ class C5Dataset(Base):
     #:
     cmor_table = Column(Text)
 
+    #: Experiment families of the experiment, e.g. ['All', 'RCP']
+    experiment_family = Column(ARRAY(Text))
+
 
 class C6Dataset(Base):
     """A CMIP6-era ESGF dataset
@@ -254,6 +257,9 @@ class C6Dataset(Base):
     #:
     activity_id = Column('activity_id', Text)
 
+    #: activity_id split in a list, as it can have more than one value
+    activity_ids = Column(ARRAY(Text))
+
     #:
     institution_id = Column('institution_id', Text)
 
@@ -318,6 +324,7 @@ class CordexDataset(Base):
     driving_experiment = Column('driving_experiment', Text)
     #ensemble = Column('driving_model_ensemble_member', Text)
     ensemble = Column('ensemble', Text)
+    experiment_family = Column(ARRAY(Text))
 
     rcm_name = column_property(f.substr(model_id, f.char_length(institute) + 2))
 
@@ -17,6 +17,8 @@
 # From https://bitbucket.org/zzzeek/sqlalchemy/wiki/UsageRecipes/PGValues
 
 
+from sqlalchemy import bindparam, func
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.sql.expression import FromClause
 
@@ -52,3 +54,28 @@ def compile_values(element, compiler, asfrom=False, **kw):
         else:
             v = "(%s)" % v
     return v
+
+
+def array_values(columns, rows, name=None):
+    """VALUES table sent to the database as one array parameter per column
+
+    Unlike :class:`values` the rows are not rendered in the SQL text, each
+    column is bound as an array and expanded on the server with
+    ``unnest(...) WITH ORDINALITY``, so the statement size doesn't depend on
+    the number of rows. The row position is available as the extra column
+    'ordinality'.
+
+    Args:
+        columns (list): :func:`sqlalchemy.sql.column` objects with a type
+        rows (list): tuples of values, in the same order as columns
+        name (str): name of the table in the query
+
+    Returns:
+        A selectable that can be joined with other tables
+    """
+    data = list(zip(*rows)) if len(rows) > 0 else [()] * len(columns)
+    arrays = [bindparam(f'{c.name}_values', value=list(d), type_=ARRAY(c.type), unique=True)
+              for c, d in zip(columns, data)]
+    return (func.unnest(*arrays)
+            .table_valued(*columns, with_ordinality='ordinality')
+            .render_derived(name=name))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# Copyright 2023 ARC Centre of Excellence for Climate Extremes
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compiled store of the project vocabularies
+
+The accepted facet values, facet names, constraint names and model name fixes
+of each project are read from the JSON files in ``clef/data``. ``make vocab``
+(``python -m clef.vocab``) compiles them into a single file,
+``data/vocab.pickle``, which is loaded the first time a vocabulary is needed
+and then kept in memory. If the file is missing, or older than the JSON files,
+the store is built from the JSON files instead.
+
+Lookups are returned as read-only mappings of tuples and frozensets, so the
+cached store can be shared safely:
+
+* :func:`vocabulary` accepted values of each facet
+* :func:`value_sets` the same values as sets, to validate constraints
+* :func:`valid_keys` and :func:`key_aliases` constraint names of each facet
+* :func:`facet_names` facet names by short name
+* :func:`model_fix` model names used in files and by ESGF
+"""
+
+import os
+import sys
+import json
+import pickle
+import pkg_resources
+from types import MappingProxyType
+
+from .exception import ClefException
+
+
+#: Projects with vocabularies
+projects = ['CMIP5', 'CMIP6', 'CORDEX']
+
+#: Short names of the facets in data/facets.json, in the same order
+facet_keys = ['mip', 'pr', 'e', 'f', 'gr', 'inst', 'era', 'res', 'prod',
+              'r', 'm', 'mtype', 'se', 't', 'v', 'vl', 'en', 'ef', 'cf',
+              'd', 'rcmv', 'vrs', 'dex', 'dmod']
+
+#: Layout version of the compiled store, a file with another version is ignored
+store_version = 1
+
+_store = None
+
+
+def _data_file(name):
+    return pkg_resources.resource_filename(__name__, 'data/' + name)
+
+
+def _read_json(name):
+    with open(_data_file(name), 'r') as f:
+        return json.loads(f.read())
+
+
+def source_files():
+    """Return the data files compiled in the store
+    """
+    files = ['valid_keys.json', 'facets.json']
+    for p in projects:
+        files.append(f'{p}_validation.json')
+        if os.path.exists(_data_file(f'{p}_model_fix.json')):
+            files.append(f'{p}_model_fix.json')
+    return files
+
+
+def compile_store():
+    """Read the data JSON files into the store
+
+    Returns:
+        store (dict): lookups by name and project
+    """
+    store = {'version': store_version, 'vocabularies': {}, 'values': {},
+             'keys': {}, 'aliases': {}, 'facets': {}, 'model_fix': {}, 'model_unfix': {}}
+    keys = _read_json('valid_keys.json')
+    names = list(_read_json('facets.json').values())
+    # facets.json values are the facet names for CMIP6, CMIP5 and CORDEX
+    columns = {'CMIP6': 0, 'CMIP5': 1, 'CORDEX': 2}
+    for p in projects:
+        vocab = _read_json(f'{p}_validation.json')
+        store['vocabularies'][p] = {k: tuple(v) for k, v in vocab.items()}
+        store['values'][p] = {k: frozenset(v) for k, v in vocab.items()}
+        # valid_keys.json keys are all the names accepted for a facet, i.e.
+        # 'source_id:model:m': {'CMIP5': 'model', 'CMIP6': 'source_id', ...}
+        store['keys'][p] = {v[p]: tuple(k.split(':')) for k, v in keys.items() if v[p] != 'NA'}
+        aliases = {}
+        for facet, names_ in store['keys'][p].items():
+            for n in names_:
+                aliases.setdefault(n, facet)
+        store['aliases'][p] = aliases
+        store['facets'][p] = {k: v[columns[p]] for k, v in zip(facet_keys, names)}
+        mfix = {}
+        if os.path.exists(_data_file(f'{p}_model_fix.json')):
+            mfix = _read_json(f'{p}_model_fix.json')
+        store['model_fix'][p] = mfix
+        store['model_unfix'][p] = {v: k for k, v in mfix.items()}
+    return store
+
+
+def store_path():
+    """Return the path of the compiled store
+    """
+    return _data_file('vocab.pickle')
+
+
+def write_store(path=None):
+    """Compile the data JSON files and write the store to path
+
+    Args:
+        path (str): output file, by default :func:`store_path`
+    """
+    path = path or store_path()
+    with open(path, 'wb') as f:
+        pickle.dump(compile_store(), f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def _load_store():
+    path = store_path()
+    try:
+        mtime = os.path.getmtime(path)
+        if all(os.path.getmtime(_data_file(f)) <= mtime for f in source_files()):
+            with open(path, 'rb') as f:
+                store = pickle.load(f)
+            if store.get('version') == store_version:
+                return store
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+    return compile_store()
+
+
+def get_store():
+    """Return the store, loading it the first time it is needed
+    """
+    global _store
+    if _store is None:
+        _store = _load_store()
+    return _store
+
+
+def _lookup(name, project):
+    return MappingProxyType(get_store()[name][_project(project)])
+
+
+def _project(project):
+    project = project.upper().split('-')[0]
+    if project not in projects:
+        raise ClefException(f"Vocabularies not defined for project: {project}")
+    return project
+
+
+def vocabulary(project):
+    """Return the accepted values of each facet
+
+    Args:
+        project (str): data project, i.e. CMIP5, CMIP6 or CORDEX (CORDEX-Adjust ...)
+
+    Returns:
+        vocab (mapping): {facet: tuple of values}
+    """
+    return _lookup('vocabularies', project)
+
+
+def value_sets(project):
+    """Return the accepted values of each facet as sets
+
+    >>> 'tas' in value_sets('CMIP5')['variable']
+    True
+
+    Args:
+        project (str): data project
+
+    Returns:
+        vocab (mapping): {facet: frozenset of values}
+    """
+    return _lookup('values', project)
+
+
+def valid_keys(project):
+    """Return the constraint names accepted for each facet
+
+    Args:
+        project (str): data project
+
+    Returns:
+        keys (mapping): {facet: tuple of names}
+    """
+    return _lookup('keys', project)
+
+
+def key_aliases(project):
+    """Return the facet corresponding to each accepted constraint name
+
+    >>> key_aliases('CMIP6')['m']
+    'source_id'
+
+    Args:
+        project (str): data project
+
+    Returns:
+        aliases (mapping): {name: facet}
+    """
+    return _lookup('aliases', project)
+
+
+def facet_names(project):
+    """Return the facet names by short name, None if not defined for project
+
+    Args:
+        project (str): data project
+
+    Returns:
+        facets (mapping): {short name: facet}
+    """
+    return _lookup('facets', project)
+
+
+def model_fix(project, invert=False):
+    """Return the model names to replace
+
+    Args:
+        project (str): data project
+        invert (bool): from the ESGF names (``CESM1(BGC)``) to the file
+            names (``CESM1-BGC``) instead
+
+    Returns:
+        mfix (mapping): {name: replacement}
+    """
+    return _lookup('model_unfix' if invert else 'model_fix', project)
+
+
+if __name__ == '__main__':
+    print(write_store(sys.argv[1] if len(sys.argv) > 1 else None))
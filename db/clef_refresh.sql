@@ -0,0 +1,13 @@
+/*
+ * Last refresh of the materialized views, updated at the end of refresh.sql.
+ * Included by tables.sql and refresh.sql, so that a refresh works on a
+ * database created before the table was added.
+ * clef keeps the results of local queries until refresh_id changes
+ */
+CREATE TABLE IF NOT EXISTS clef_refresh (
+    id integer PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    refresh_id bigint NOT NULL DEFAULT 1,
+    refreshed timestamp with time zone NOT NULL DEFAULT now()
+    );
+GRANT SELECT ON clef_refresh TO PUBLIC;
+INSERT INTO clef_refresh DEFAULT VALUES ON CONFLICT (id) DO NOTHING;
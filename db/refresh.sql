@@ -1,3 +1,4 @@
+\ir clef_refresh.sql
 REFRESH MATERIALIZED VIEW CONCURRENTLY esgf_paths;
 REFRESH MATERIALIZED VIEW CONCURRENTLY c5_metadata_dataset_link;
 REFRESH MATERIALIZED VIEW CONCURRENTLY c6_metadata_dataset_link;
@@ -5,3 +6,4 @@ REFRESH MATERIALIZED VIEW CONCURRENTLY cmip5_dataset;
 REFRESH MATERIALIZED VIEW CONCURRENTLY cmip6_dataset;
 REFRESH MATERIALIZED VIEW CONCURRENTLY extended_metadata;
 REFRESH MATERIALIZED VIEW CONCURRENTLY checksums;
+UPDATE clef_refresh SET refresh_id = refresh_id + 1, refreshed = now();
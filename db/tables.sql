@@ -95,6 +95,24 @@ CREATE UNIQUE INDEX IF NOT EXISTS checksums_hash_idx ON checksums(ch_hash);
 CREATE INDEX IF NOT EXISTS checksums_md5_idx ON checksums(ch_md5);
 CREATE INDEX IF NOT EXISTS checksums_sha256_idx ON checksums(ch_sha256);
 
+/*
+ * Experiment families of a CMIP5 or CORDEX experiment, used by the
+ * experiment_family constraint. Every experiment is in 'All'
+ */
+CREATE OR REPLACE FUNCTION experiment_families(experiment text) RETURNS text[] AS $$
+    SELECT ARRAY_REMOVE(ARRAY[
+        'All',
+        CASE WHEN experiment LIKE '%rcp%' THEN 'RCP' END,
+        CASE WHEN experiment LIKE 'esm%' THEN 'ESM' END,
+        CASE WHEN experiment LIKE ANY (ARRAY['sst%', 'amip%', 'aqua%']) THEN 'Atmos-only' END,
+        CASE WHEN experiment LIKE ANY (ARRAY['sstClim%', '%Control']) THEN 'Control' END,
+        CASE WHEN experiment LIKE ANY (ARRAY['decadal%', 'noVolc%', 'volcIn%']) THEN 'Decadal' END,
+        CASE WHEN experiment LIKE '%CO2' THEN 'Idealized' END,
+        CASE WHEN experiment IN ('lgm', 'midHolocene', 'past1000') THEN 'Paleo' END,
+        CASE WHEN experiment LIKE ANY (ARRAY['historical%', '%Historical']) THEN 'Historical' END
+    ], NULL)
+$$ LANGUAGE SQL IMMUTABLE;
+
 /* modified this so it works with both cmip5 and cmip6 using attributes_map.json */
 CREATE OR REPLACE VIEW c5_dataset_metadata AS
     SELECT
@@ -203,9 +221,11 @@ CREATE MATERIALIZED VIEW cordex_dataset AS
         rcm_version,
         driving_model,
         driving_experiment,
-        ensemble
+        ensemble,
+        experiment_families(experiment) AS experiment_family  /** used by the experiment_family constraint **/
     FROM cordex_dataset_metadata
     JOIN x USING (file_id);
+CREATE INDEX IF NOT EXISTS cordex_dataset_experiment_family ON cordex_dataset USING GIN (experiment_family);
 GRANT SELECT ON cordex_dataset TO PUBLIC;
 
 
@@ -279,10 +299,12 @@ CREATE MATERIALIZED VIEW IF NOT EXISTS cmip5_dataset AS
         r,
         i,
         p,
-        'r'||r||'i'||i||'p'||p AS ensemble
+        'r'||r||'i'||i||'p'||p AS ensemble,
+        experiment_families(experiment) AS experiment_family  /** used by the experiment_family constraint **/
     FROM c5_dataset_metadata
     NATURAL JOIN c5_metadata_dataset_link;
 CREATE UNIQUE INDEX IF NOT EXISTS cmip5_dataset_dataset_id ON cmip5_dataset(dataset_id);
+CREATE INDEX IF NOT EXISTS cmip5_dataset_experiment_family ON cmip5_dataset USING GIN (experiment_family);
 GRANT SELECT ON cmip5_dataset TO PUBLIC;
     
 CREATE MATERIALIZED VIEW IF NOT EXISTS cmip6_dataset AS
@@ -290,6 +312,7 @@ CREATE MATERIALIZED VIEW IF NOT EXISTS cmip6_dataset AS
         dataset_id,
         project,
         activity_id,  /** .e.CMIP for DECK etc **/ 
+        string_to_array(activity_id, ' ') AS activity_ids,  /** one element for each activity **/
         institution_id,
         source_id,  /** instead of model **/
         source_type,  /** AOGM, BGC **/
@@ -314,6 +337,7 @@ CREATE MATERIALIZED VIEW IF NOT EXISTS cmip6_dataset AS
     FROM c6_dataset_metadata
     NATURAL JOIN c6_metadata_dataset_link;
 CREATE UNIQUE INDEX IF NOT EXISTS cmip6_dataset_dataset_id ON cmip6_dataset(dataset_id);
+CREATE INDEX IF NOT EXISTS cmip6_dataset_activity_ids ON cmip6_dataset USING GIN (activity_ids);
 GRANT SELECT ON cmip6_dataset TO PUBLIC;
 /* Extra metadata not stored in the file itself. This table stores manually
  * entered data, automatic data is in the view `extended_metadata_path` and
@@ -416,3 +440,8 @@ CREATE OR REPLACE VIEW info_attributes AS
     md_json->'attributes'->>'tracking_id' as tracking_id
     FROM metadata
     WHERE md_type = 'netcdf';
+
+/*
+ * Last refresh of the materialized views, see clef_refresh.sql
+ */
+\ir clef_refresh.sql
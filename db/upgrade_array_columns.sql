@@ -0,0 +1,18 @@
+/*
+ * Upgrade a database created before the experiment_family and activity_ids
+ * array columns were added to the dataset views.
+ *
+ * tables.sql only creates the materialized views if they don't exist, so an
+ * existing database keeps the old views without the columns that clef now
+ * queries. This drops the dataset views and creates them again from tables.sql,
+ * run it from the db directory:
+ *
+ *     psql -f upgrade_array_columns.sql
+ */
+BEGIN;
+DROP MATERIALIZED VIEW IF EXISTS cmip5_dataset;
+DROP MATERIALIZED VIEW IF EXISTS cmip6_dataset;
+DROP MATERIALIZED VIEW IF EXISTS cordex_dataset;
+COMMIT;
+
+\ir tables.sql
@@ -20,6 +20,13 @@ def pytest_runtest_setup(item):
             pytest.skip('Not the production db')
 
 
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    """Keep the query caches in a temporary directory"""
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    return tmp_path
+
+
 # Add test fixtures here so they are accessible from doctests
 @pytest.fixture(scope='session')
 def session(pytestconfig):
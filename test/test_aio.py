@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Copyright 2023 ARC Centre of Excellence for Climate Extremes
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+
+from clef import aio, esgf
+from test_esgf import paged_query, missing_query
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+# Tests for the functions defined in aio.py
+
+
+def test_esgf_query_concurrency():
+    running = []
+    peak = []
+    lock = threading.Lock()
+    def query(*args, **kwargs):
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+        return kwargs['source_id']
+
+    async def main():
+        return await asyncio.gather(*[aio.esgf_query(source_id=str(i)) for i in range(8)])
+
+    try:
+        aio.configure_aio(3)
+        with mock.patch('clef.esgf.esgf_query', side_effect=query):
+            results = asyncio.run(main())
+        assert results == [str(i) for i in range(8)]
+        assert max(peak) == 3
+    finally:
+        aio.configure_aio(8)
+
+
+def test_esgf_docs():
+    with mock.patch('clef.esgf.esgf_query', side_effect=paged_query):
+        docs = asyncio.run(aio.esgf_docs('', 'id', limit=10))
+    assert [d['id'] for d in docs] == [str(i) for i in range(25)]
+
+
+def test_find_checksum_id_async():
+    with mock.patch('clef.esgf.esgf_query', side_effect=missing_query):
+        table, nocksum = asyncio.run(aio.find_checksum_id_async(''))
+    assert nocksum is False
+
+
+def test_configure_aio_pool_size():
+    with mock.patch.dict('clef.esgf.http_config', {'pool_size': 32}):
+        try:
+            aio.configure_aio(16)
+            assert esgf.http_config['pool_size'] == 16 * aio.search_workers
+            # the pool is never made smaller
+            aio.configure_aio(2)
+            assert esgf.http_config['pool_size'] == 16 * aio.search_workers
+        finally:
+            aio.configure_aio(8)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# Copyright 2023 ARC Centre of Excellence for Climate Extremes
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import json
+import itertools
+import sqlite3
+import pytest
+
+from clef.cache import DiskCache, MemoryCache, canonical_key, configure_cache, get_cache, cache_config, \
+                       configure_local_cache, get_local_cache
+from clef.esgf import esgf_query
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+# Tests for the functions defined in cache.py
+
+
+def test_canonical_key():
+    k1 = canonical_key({'project': 'CMIP6', 'variable_id': ('tas', 'pr'), 'query': None})
+    k2 = canonical_key({'variable_id': ['pr', 'tas'], 'project': 'CMIP6', 'source_id': ()})
+    assert k1 == k2
+    assert k1 != canonical_key({'project': 'CMIP6', 'variable_id': ['tas']})
+    assert canonical_key({'offset': 0}) != canonical_key({'offset': 10})
+    # a single value and a list of one value are the same query
+    assert canonical_key({'project': 'CMIP6', 'variable_id': 'tas'}) == \
+           canonical_key({'project': ['CMIP6'], 'variable_id': ('tas',)})
+
+
+def test_disk_cache(tmp_path):
+    cache = DiskCache(str(tmp_path / 'test.sqlite'), max_size=100000)
+    assert cache.get('a') is None
+    cache.put('a', b'value a')
+    assert cache.get('a') == b'value a'
+    # expired entries are removed
+    with mock.patch('clef.cache.time.time', return_value=time.time() + 100):
+        assert cache.get('a', ttl=10) is None
+    assert cache.get('a') is None
+
+
+def test_disk_cache_errors(tmp_path, caplog):
+    # errors are a miss or a no-op, and are logged once
+    cache = DiskCache(str(tmp_path / 'test.sqlite'), max_size=100000)
+    cache.put('a', b'value a')
+    with mock.patch.object(cache, '_connect', side_effect=sqlite3.OperationalError('database is locked')):
+        assert cache.get('a') is None
+        cache.put('b', b'value b')
+    assert len([r for r in caplog.records if 'locked' in r.getMessage()]) == 1
+    conn = sqlite3.connect(cache.path)
+    with conn:
+        conn.execute("UPDATE cache SET value = ? WHERE key = 'a'", (b'corrupt',))
+    conn.close()
+    assert cache.get('a') is None
+
+
+def test_disk_cache_eviction(tmp_path):
+    # incompressible values of about 400 bytes, only 2 fit in the cache
+    values = {k: os.urandom(400) for k in 'abc'}
+    cache = DiskCache(str(tmp_path / 'test.sqlite'), max_size=1000)
+    with mock.patch('clef.cache.time.time', side_effect=itertools.count()):
+        cache.put('a', values['a'])
+        cache.put('b', values['b'])
+        # use a so b is the least recently used
+        assert cache.get('a') == values['a']
+        cache.put('c', values['c'])
+        assert cache.get('b') is None
+        assert cache.get('a') == values['a']
+        assert cache.get('c') == values['c']
+
+
+def test_esgf_query_cache():
+    response = {'response': {'numFound': 0, 'docs': []}}
+    r = mock.Mock()
+    r.content = json.dumps(response).encode('utf-8')
+    r.json.return_value = response
+    with mock.patch('clef.esgf.esgf_get', return_value=r) as get:
+        assert esgf_query(project='CMIP6', variable_id=('tas', 'pr')) == response
+        assert esgf_query(variable_id=['pr', 'tas'], project='CMIP6') == response
+        assert get.call_count == 1
+
+        # ttl=0 means the cached response has expired
+        esgf_query(project='CMIP6', variable_id=('tas', 'pr'), ttl=0)
+        assert get.call_count == 2
+
+        try:
+            configure_cache(refresh=True)
+            esgf_query(project='CMIP6', variable_id=('tas', 'pr'))
+            assert get.call_count == 3
+            configure_cache(refresh=False, enabled=False)
+            assert get_cache() is None
+            esgf_query(project='CMIP6', variable_id=('tas', 'pr'))
+            assert get.call_count == 4
+        finally:
+            configure_cache(enabled=True, refresh=False)
+
+
+def test_memory_cache():
+    cache = MemoryCache(max_entries=2)
+    cache.put('a', [1])
+    cache.put('b', [2])
+    # use a so b is the least recently used
+    assert cache.get('a') == [1]
+    cache.put('c', [3])
+    assert cache.get('b') is None
+    assert cache.get('a') == [1]
+    assert cache.get('c') == [3]
+
+
+def test_local_cache_config(tmp_path):
+    try:
+        memory, disk = get_local_cache()
+        assert disk is None
+        configure_local_cache(disk=True, path=str(tmp_path / 'local.sqlite'))
+        memory, disk = get_local_cache()
+        assert disk.path == str(tmp_path / 'local.sqlite')
+        configure_local_cache(enabled=False)
+        assert get_local_cache() == (None, None)
+    finally:
+        configure_local_cache(enabled=True, disk=False, path='')
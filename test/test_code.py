@@ -15,8 +15,18 @@
 # limitations under the License.
 
 import pytest
+import itertools
+from unittest import mock
 
-from clef.code import and_filter, matching, local_latest, search, stats, ids_df
+from clef.code import and_filter, matching, local_latest, search, stats, ids_df, stream_local_paths, build_query, \
+                       local_query, compact_frame, local_query_chunks, write_csv_chunks, local_statement, refresh_token, \
+                       all_of_query
+from clef.pgvalues import array_values
+import pandas as pd
+import sqlalchemy as sa
+from psycopg2.extras import NumericRange
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects import postgresql
 from code_fixtures import *
 from clef.exception import ClefException
 
@@ -31,13 +41,13 @@ def test_and_filter(local_results, remote_results):
     # mod2/exp1/r1i1p1
     # mod2/exp2/r1i1p1
     rows, selection = and_filter(local_results, ['variable'],['model','ensemble','experiment'], **kwargs)
-    assert selection['comb'][0] == { ('tas', ), ('pr', )}
+    assert selection['comb'].iloc[0] == { ('tas', ), ('pr', )}
     assert len(selection.index) == 3
     assert len(rows.index) == 6 
     # test local CMIP5 query results applying AND to variables, experiments and model, ensemble to identify run
     rows, selection = and_filter(local_results, ['variable','experiment'],
                 ['model','ensemble'], **kwargs)
-    assert selection['comb'][0] == { ('tas', 'exp1'), ('pr', 'exp1'),
+    assert selection['comb'].iloc[0] == { ('tas', 'exp1'), ('pr', 'exp1'),
                                      ('tas', 'exp2'), ('pr', 'exp2')}
     assert len(selection.index) == 1 
     assert len(rows.index) == 4
@@ -54,7 +64,7 @@ def test_and_filter(local_results, remote_results):
               'table_id': ['Amon'], 'member_id': ['r1i1p1f1','r2i1p1f1']}
     rows, selection = and_filter(remote_results, ['variable_id'],
                 ['source_id','member_id','experiment_id'], **kwargs)
-    assert selection['comb'][0] == { ('tas', ), ('pr', )}
+    assert selection['comb'].iloc[0] == { ('tas', ), ('pr', )}
     assert len(selection.index) == 4 
     assert len(rows.index) == 8
     dids = rows['dataset_id'].tolist()
@@ -64,7 +74,7 @@ def test_and_filter(local_results, remote_results):
     # test remote CMIP6 query results apply AND to variables, experiments and model, member to identify run
     rows, selection = and_filter(remote_results, ['variable_id','experiment_id'],
                            ['source_id','member_id'], **kwargs)
-    assert selection['comb'][0] == { ('tas', 'exp1'), ('pr', 'exp1'),
+    assert selection['comb'].iloc[0] == { ('tas', 'exp1'), ('pr', 'exp1'),
                                      ('tas', 'exp2'), ('pr', 'exp2')}
     assert len(selection.index) == 1 
     assert len(rows.index) == 4
@@ -162,3 +172,248 @@ def test_matching(session):
 def test_ids_df(dids6, results6, dids5, results5):
     assert ids_df(dids6).equals(results6)
     assert ids_df(dids5).equals(results5)
+
+
+def test_stream_local_paths():
+    # the directories are fixed by the database, each one is returned once
+    rows = [('/g/data/al33/replicas/CMIP5/combined/M/m/e/mon/atmos/Amon/r1i1p1/v1/tas/',),
+            ('/g/data/al33/replicas/CMIP5/combined/M/m/e/mon/atmos/Amon/r1i1p1/v1/tas/',),
+            ('/g/data/al33/replicas/CMIP5/combined/M/m/e/mon/atmos/Amon/r1i1p1/v2/tas/',),
+            ('/path/todelete/',)]
+    with mock.patch('clef.code.build_query') as build_query:
+        build_query.return_value.with_entities.return_value.order_by.return_value.yield_per.return_value = rows
+        paths = list(stream_local_paths(None, 'cmip5', True, model=('m',)))
+    assert build_query.call_args[0][1] == 'CMIP5'
+    column = build_query.return_value.with_entities.call_args[0][0]
+    assert 'regexp_replace' in str(column.compile(dialect=postgresql.dialect()))
+    assert paths == ['/g/data/al33/replicas/CMIP5/combined/M/m/e/mon/atmos/Amon/r1i1p1/v1/tas',
+                     '/g/data/al33/replicas/CMIP5/combined/M/m/e/mon/atmos/Amon/r1i1p1/v2/tas']
+
+
+def test_build_query_multiple_values():
+    # all the values of a constraint are matched by one query
+    q = build_query(Session(), 'CMIP5', model=('mod1', 'mod2'), variable=('tas', 'pr'),
+                    experiment='exp1')
+    sql = q.statement.compile(dialect=postgresql.dialect())
+    assert 'cmip5_dataset.model = ANY' in str(sql)
+    assert 'extended_metadata.variable = ANY' in str(sql)
+    assert 'cmip5_dataset.experiment = ' in str(sql)
+    assert sorted(v for v in sql.params.values() if isinstance(v, list)) == [['mod1', 'mod2'], ['tas', 'pr']]
+    # an empty list of values matches nothing
+    q = build_query(Session(), 'CMIP5', model=[], experiment='exp1')
+    sql = q.statement.compile(dialect=postgresql.dialect())
+    assert 'cmip5_dataset.model = ANY' in str(sql)
+    assert sql.params['model'] == []
+
+
+def test_local_query_aggregated():
+    # rows aggregated by directory in the database are combined by fixed path
+    base = '/g/data/al33/replicas/CMIP5/{}/M/m/e/mon/atmos/Amon/r1i1p1/v1/tas'
+    rows = pd.DataFrame({'directory': [base.format('output1'), base.format('output2')],
+                         'filename': [['a.nc', 'b.nc'], ['c.nc']],
+                         'model': ['m', 'm'], 'version': ['v1', 'v1'],
+                         'period': [[NumericRange(200001, 200013), NumericRange(200101, 200113)],
+                                    [NumericRange(200201, 200213)]]})
+    with mock.patch('clef.code.pd.read_sql', return_value=rows), \
+         mock.patch('clef.code.local_statement', return_value=(None, {})):
+        res = local_query(mock.MagicMock(), 'CMIP5', model=['m'])
+    assert len(res.index) == 1
+    row = res.iloc[0]
+    assert row['path'] == base.format('combined')
+    assert row['filename'] == {'a.nc', 'b.nc', 'c.nc'}
+    assert (row['fdate'], row['tdate']) == ('20000101', '20021231')
+    assert row['time_complete'] == True
+
+
+def test_compact_frame(local_results):
+    df = local_results.assign(filename=[{'b.nc', 'a.nc'}] * len(local_results.index))
+    assert compact_frame(df) is df
+    res = compact_frame(df, True)
+    assert res['model'].dtype == 'category'
+    assert res['filename'].dtype == object
+    assert list(res['filename'].iloc[0]) == ['a.nc', 'b.nc']
+    assert res.memory_usage(deep=True).sum() < df.memory_usage(deep=True).sum()
+    # grouping categories returns only the observed combinations
+    sdf = stats(res, 'CMIP5')
+    assert sorted(sdf.index.values) == ['mod1', 'mod2', 'mod3']
+    assert sdf['count'].sum() == 5
+    kwargs = {'experiment': ['exp1','exp2'], 'variable': ['tas','pr'],
+              'cmor_table': ['Amon'], 'ensemble': ['r1i1p1','r2i1p1']}
+    rows, selection = and_filter(res, ['variable'], ['model','ensemble','experiment'], **kwargs)
+    assert len(selection.index) == 3
+
+
+def test_build_query_latest():
+    # the latest versions are selected in the database
+    q = build_query(Session(), 'CMIP5', latest=True, model='mod1')
+    sql = str(q.statement.compile(dialect=postgresql.dialect()))
+    assert 'dense_rank() OVER (PARTITION BY cmip5_dataset.project' in sql
+    assert 'DESC NULLS LAST' in sql
+    assert 'cmip5_dataset.r,' not in sql
+    assert [c['name'] for c in q.column_descriptions] == \
+           [c['name'] for c in build_query(Session(), 'CMIP5', model='mod1').column_descriptions]
+
+
+def test_local_query_unversioned():
+    # datasets without a version in the database are compared using the path
+    base = '/g/data/al33/replicas/CMIP5/output1/M/m/e/mon/atmos/Amon/r1i1p1/{}/tas'
+    rows = pd.DataFrame({'directory': [base.format('v20120101'), base.format('v20130101')],
+                         'filename': [['a.nc'], ['a.nc']],
+                         'model': ['m', 'm'], 'version': [None, None],
+                         'period': [[NumericRange(200001, 200013)], [NumericRange(200001, 200013)]]})
+    with mock.patch('clef.code.pd.read_sql', return_value=rows), \
+         mock.patch('clef.code.local_statement', return_value=(None, {})) as local_statement:
+        res = local_query(mock.MagicMock(), 'CMIP5', filter_latest=True, model=['m'])
+    assert local_statement.call_args[0] == ('CMIP5', True)
+    assert res['version'].tolist() == ['v20130101']
+
+
+def test_local_query_chunks(tmp_path, monkeypatch):
+    # directories combined in one dataset can be read in different chunks
+    base = '/g/data/al33/replicas/CMIP5/{}/M/{}/e/mon/atmos/Amon/r1i1p1/v1/tas'
+    def chunk(dirs):
+        return pd.DataFrame({'directory': [base.format(*d) for d in dirs],
+                             'filename': [['a.nc']] * len(dirs),
+                             'model': [d[1] for d in dirs], 'version': ['v1'] * len(dirs),
+                             'period': [[NumericRange(200001, 200013)]] * len(dirs)})
+    chunks = [chunk([('output1', 'm1'), ('output1', 'm2')]), chunk([('output2', 'm2'), ('output1', 'm3')])]
+    session = mock.MagicMock()
+    with mock.patch('clef.code.pd.read_sql', return_value=iter(chunks)) as read_sql, \
+         mock.patch('clef.code.local_statement', return_value=(mock.MagicMock(), {})), \
+         mock.patch('clef.code.fix_path_sql'):
+        res = list(local_query_chunks(session, 'CMIP5', chunksize=2, model=['m1', 'm2', 'm3']))
+    assert read_sql.call_args[1]['chunksize'] == 2
+    session.connection.return_value.execution_options.assert_called_with(stream_results=True)
+    assert [r['model'].tolist() for r in res] == [['m1'], ['m2'], ['m3']]
+    assert res[1].iloc[0]['filename'] == {'a.nc'}
+    assert res[1].iloc[0]['path'] == base.format('combined', 'm2')
+
+    monkeypatch.chdir(tmp_path)
+    write_csv_chunks(res)
+    lines = (tmp_path / 'CMIP5_query.csv').read_text().splitlines()
+    assert len(lines) == 4
+    assert lines[0].startswith('path,')
+
+
+def test_local_query_cache():
+    # repeated queries are read from the cache until the database is refreshed
+    base = '/g/data/al33/replicas/CMIP5/output1/M/m/e/mon/atmos/Amon/r1i1p1/v1/{}'
+    rows = pd.DataFrame({'directory': [base.format('tas')], 'filename': [['a.nc']],
+                         'model': ['m'], 'version': ['v1'],
+                         'period': [[NumericRange(200001, 200013)]]})
+    with mock.patch('clef.code.pd.read_sql', return_value=rows) as read_sql, \
+         mock.patch('clef.code.local_statement', return_value=(None, {})), \
+         mock.patch('clef.code.refresh_token', return_value='token1') as token:
+        res1 = local_query(mock.MagicMock(), 'CMIP5', model=['m'], variable='tas')
+        res2 = local_query(mock.MagicMock(), 'cmip5', variable=['tas'], model='m')
+        assert read_sql.call_count == 1
+        assert res2.equals(res1)
+        token.return_value = 'token2'
+        local_query(mock.MagicMock(), 'CMIP5', model=['m'], variable='tas')
+        assert read_sql.call_count == 2
+
+
+def test_local_query_disk_cache_corrupt():
+    # an entry that can't be unpickled is a miss, and is replaced
+    rows = pd.DataFrame({'directory': ['/g/data/al33/replicas/CMIP5/output1/M/m/e/mon/atmos/Amon/r1i1p1/v1/tas'],
+                         'filename': [['a.nc']], 'model': ['m'], 'version': ['v1'],
+                         'period': [[NumericRange(200001, 200013)]]})
+    memory, disk = mock.MagicMock(), mock.MagicMock()
+    memory.get.return_value = None
+    disk.get.return_value = b'truncated'
+    with mock.patch('clef.code.pd.read_sql', return_value=rows) as read_sql, \
+         mock.patch('clef.code.local_statement', return_value=(None, {})), \
+         mock.patch('clef.code.refresh_token', return_value='token1'), \
+         mock.patch('clef.code.get_local_cache', return_value=(memory, disk)):
+        res = local_query(mock.MagicMock(), 'CMIP5', model='m')
+    assert read_sql.call_count == 1
+    assert len(res) == 1
+    disk.put.assert_called_once()
+
+
+def test_refresh_token():
+    # the token is read from the table updated by db/refresh.sql
+    session = mock.MagicMock()
+    session.get_bind.return_value.url = 'postgresql://db1'
+    session.execute.return_value.scalar.return_value = True
+    session.execute.return_value.first.return_value = (3, '2023-05-01 10:00:00+00')
+    with mock.patch('clef.code._refresh_tables', {}):
+        token = refresh_token(session)
+        assert 'clef_refresh' in str(session.execute.call_args[0][0])
+        session.execute.return_value.first.return_value = (4, '2023-05-02 10:00:00+00')
+        assert refresh_token(session) != token
+        # the table is checked only once
+        assert sum('to_regclass' in str(c[0][0]) for c in session.execute.call_args_list) == 1
+
+        # no caching without the table, and the session is left alone
+        session = mock.MagicMock()
+        session.get_bind.return_value.url = 'postgresql://db2'
+        session.execute.return_value.scalar.return_value = False
+        assert refresh_token(session) is None
+        assert refresh_token(session) is None
+        assert session.execute.call_count == 1
+        session.rollback.assert_not_called()
+
+
+def test_all_of_query_and_filter(session, local_results):
+    # the SQL filter selects the same simulations as and_filter
+    names = ['model', 'experiment', 'ensemble', 'variable', 'pdir']
+    rows = [tuple(r) for r in local_results[names].itertuples(index=False)]
+    files = array_values([sa.column(c, sa.Text) for c in names], rows, name='files')
+    kwargs = {'experiment': ['exp1', 'exp2'], 'variable': ['tas', 'pr']}
+    for cols, fixed in [(['variable'], ['model', 'ensemble', 'experiment']),
+                        (['variable', 'experiment'], ['model', 'ensemble'])]:
+        q = all_of_query(sa.select(files), cols, fixed)
+        and_count = len(list(itertools.product(*[kwargs[c] for c in cols])))
+        sql = sorted(r.pdir for r in q.with_session(session).params(and_count=and_count))
+        assert len(sql) > 0
+        assert sql == sorted(and_filter(local_results, cols, fixed, **kwargs)[0]['pdir'])
+
+
+def test_local_statement():
+    # queries with the same constraint names share the statement, only the parameters change
+    sql1, params1 = local_statement('CMIP6', True, source_id=['A', 'B'], variable_id='tas')
+    sql2, params2 = local_statement('CMIP6', True, variable_id='pr', source_id=('C', 'D', 'E'))
+    assert sql1 is sql2
+    assert params1 == {'source_id': ['A', 'B'], 'variable_id': 'tas'}
+    assert params2 == {'source_id': ['C', 'D', 'E'], 'variable_id': 'pr'}
+    assert local_statement('CMIP6', True, source_id='A', variable_id='tas')[0] is not sql1
+    sql = str(sql1.compile(dialect=postgresql.dialect()))
+    assert 'cmip6_dataset.source_id = ANY (%(source_id)s::TEXT[])' in sql
+    assert 'cmip6_dataset.variable_id = %(variable_id)s' in sql
+    _, params = local_statement('CMIP5', experiment_family=['RCP', 'ESM'], model='m')
+    assert params == {'experiment_family': ['RCP', 'ESM'], 'model': 'm'}
+
+
+def test_local_statement_all_of():
+    # the simulations with all the combinations of values are selected in the database
+    sql, params = local_statement('CMIP6', all_of=(['variable_id', 'experiment_id'], ['source_id', 'member_id']),
+                                  variable_id=['tas', 'pr'], experiment_id=['historical', 'ssp585', 'ssp245'])
+    assert params['and_count'] == 6
+    sql = str(sql.compile(dialect=postgresql.dialect()))
+    assert 'GROUP BY files.source_id, files.member_id' in sql
+    assert 'HAVING count(DISTINCT (files.variable_id, files.experiment_id)) = %(and_count)s' in sql
+    # attributes that are not columns of the query are left to and_filter
+    sql, params = local_statement('CORDEX', all_of=(['variable'], ['domain', 'rcm_name']),
+                                  variable=['tas', 'pr'])
+    assert 'and_count' not in params
+    assert 'HAVING' not in str(sql.compile(dialect=postgresql.dialect()))
+
+
+def test_build_query_arrays():
+    # families and activities are matched to the array columns, which are not returned
+    q = build_query(Session(), 'CMIP6', activity_id=['CMIP', 'ScenarioMIP'])
+    sql = q.statement.compile(dialect=postgresql.dialect())
+    assert 'cmip6_dataset.activity_ids && %(activity_id)s::TEXT[]' in str(sql)
+    assert sql.params['activity_id'] == ['CMIP', 'ScenarioMIP']
+    assert 'activity_ids' not in [c['name'] for c in q.column_descriptions]
+    q = build_query(Session(), 'CMIP5', experiment_family='RCP')
+    sql = q.statement.compile(dialect=postgresql.dialect())
+    assert 'cmip5_dataset.experiment_family && %(experiment_family)s::TEXT[]' in str(sql)
+    assert sql.params['experiment_family'] == ['RCP']
+    assert 'experiment_family' not in [c['name'] for c in q.column_descriptions]
+    # activities are whole array elements, partial ids are no longer LIKE patterns
+    q = build_query(Session(), 'CMIP6', activity_id='Scenario')
+    sql = q.statement.compile(dialect=postgresql.dialect())
+    assert sql.params['activity_id'] == ['Scenario']
+    assert 'LIKE' not in str(sql)
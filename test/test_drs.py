@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Copyright 2023 ARC Centre of Excellence for Climate Extremes
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import pandas as pd
+from unittest import mock
+
+from clef.drs import parse_ids, build_ids, normalize_ids, id_facets
+from clef.esdoc import citation
+from clef.exception import ClefException
+from code_fixtures import *
+
+
+def test_parse_ids(dids6, results6, dids5, results5):
+    assert parse_ids(dids6).equals(results6)
+    assert parse_ids(pd.Series(dids5)).equals(results5)
+    # ids shorter than the template leave the last facets empty
+    df = parse_ids(['CMIP6.CMIP.NCC'])
+    assert df.loc[0, 'institution_id'] == 'NCC'
+    assert df['version'].isna().all()
+    assert list(parse_ids([], 'cordex').columns) == id_facets('CORDEX')
+    with pytest.raises(ClefException):
+        parse_ids(['obs4MIPs.a.b'])
+    with pytest.raises(ClefException):
+        parse_ids([])
+
+
+def test_build_ids(dids6, results6, dids5, results5):
+    assert build_ids(results6, 'CMIP6') == dids6
+    assert build_ids(results5, 'CMIP5') == dids5
+    df = results6.drop(columns='project')
+    df['version'] = None
+    assert build_ids(df, 'CMIP6', nfacets=5) == ['CMIP6.CMIP.NCC.NorESM2-LM.historical',
+                                                 'CMIP6.CMIP.NUIST.NESM3.historical']
+    assert build_ids(df, 'CMIP6')[0].endswith('.gn.none')
+    assert build_ids(df.iloc[:0], 'CMIP6') == []
+    with pytest.raises(ClefException):
+        build_ids(df.drop(columns='table_id'), 'CMIP6')
+
+
+def test_normalize_ids(dids5):
+    ids = normalize_ids([d + '|esgf.nci.org.au' for d in dids5])
+    assert ids.tolist() == [dids5[0], dids5[1].replace('.output.', '.output1.')]
+    assert normalize_ids([]).tolist() == []
+
+
+def test_citation_requests(dids6):
+    # one request for each simulation, the version is added to each citation
+    dids = dids6 + [dids6[0].replace('v20190920', 'v20200101')]
+    with mock.patch('clef.esdoc.requests.get') as get:
+        get.return_value.json.return_value = [{'DATA_REFERENCE': 'Version YYYYMMDD[1]. ref'}]
+        cites = citation(dids)
+        assert get.call_count == 2
+    assert cites[2] == 'Version v20200101.  ref'
@@ -23,6 +23,12 @@ except ImportError:
     import mock
 
 import pytest
+import json
+import time
+import collections
+import clef.esgf
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
 
 def empty_query(*args, **kwags):
     """
@@ -238,6 +244,22 @@ def test_find_local_path_dataset(session):
         assert results.count() == 1
         assert results[0][0] == '/g/data/rr3/publications/CMIP5/output1/CSIRO-BOM/ACCESS1-3/1pctCO2/3hr/atmos/3hr/r1i1p1/files/clt_20121011/'
 
+def test_find_local_missing(session):
+    """
+    Local paths and missing ids are returned by one query
+    """
+    with mock.patch('clef.esgf.esgf_query', side_effect=present_query):
+        subq = match_query(session, '', latest=True)
+        paths, missing = find_local_missing(session, subq)
+        assert paths == ['/g/data/rr3/publications/CMIP5/output1/CSIRO-BOM/ACCESS1-3/1pctCO2/3hr/atmos/3hr/r1i1p1/files/clt_20121011/']
+        assert missing == []
+
+    with mock.patch('clef.esgf.esgf_query', side_effect=missing_query):
+        subq = match_query(session, '', latest=True)
+        paths, missing = find_local_missing(session, subq)
+        assert paths == []
+        assert len(missing) == 1
+
 def test_find_partial_dataset(session):
     """
     Dataset is only partially available
@@ -249,6 +271,335 @@ def test_find_partial_dataset(session):
         assert results.count() == 0
 
 
+class FakeResponse:
+    """
+    Minimal :class:`requests.Response` stand-in
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+def test_esgf_get_fallback():
+    """
+    If the first node fails the query moves on to the next one
+    """
+    def get(url, params=None, timeout=None, stream=False):
+        if url == 'https://node1':
+            raise requests.exceptions.ConnectionError('down')
+        return FakeResponse({'node': url})
+
+    session = mock.Mock()
+    session.get.side_effect = get
+    with mock.patch('clef.esgf.esgf_nodes', ['https://node1', 'https://node2']):
+        with mock.patch('clef.esgf.get_http_session', return_value=session):
+            r = esgf_get({})
+            assert r.json() == {'node': 'https://node2'}
+            assert session.get.call_args[1]['timeout'] == http_config['timeout']
+
+            session.get.side_effect = requests.exceptions.ConnectionError('down')
+            with pytest.raises(ESGFException):
+                esgf_get({})
+
+def test_http_session_shared():
+    """
+    The same pooled session is reused until the settings change
+    """
+    nodes = list(esgf_nodes)
+    try:
+        s1 = get_http_session()
+        assert get_http_session() is s1
+        configure_esgf(nodes=['https://node1'], pool_size=2)
+        assert esgf_nodes == ['https://node1']
+        s2 = get_http_session()
+        assert s2 is not s1
+        assert s2.get_adapter('https://node1')._pool_maxsize == 2
+    finally:
+        configure_esgf(nodes=nodes, pool_size=10)
+
+
+def test_esgf_get_hedged():
+    """
+    A slow node is hedged by sending the request to the next node
+    """
+    slow = FakeResponse({'node': 'slow'})
+    slow.close = mock.Mock()
+    def get(url, params=None, timeout=None, stream=False):
+        if url == 'https://node1':
+            time.sleep(0.5)
+            return slow
+        return FakeResponse({'node': url})
+
+    session = mock.Mock()
+    session.get.side_effect = get
+    with mock.patch('clef.esgf.esgf_nodes', ['https://node1', 'https://node2']), \
+         mock.patch.dict('clef.esgf.http_config', {'hedge': True, 'hedge_delay': 0.05}), \
+         mock.patch('clef.esgf.node_latency', collections.defaultdict(list)), \
+         mock.patch('clef.esgf.get_http_session', return_value=session):
+        start = time.monotonic()
+        r = esgf_get({})
+        assert r.json() == {'node': 'https://node2'}
+        assert time.monotonic() - start < 0.4
+        assert len(clef.esgf.node_latency['https://node2']) == 1
+        # the slow response is released once it arrives
+        time.sleep(0.6)
+        assert slow.close.called
+
+        # the hedge delay adapts to the node response times
+        clef.esgf.node_latency['https://node1'] = [1.0] * 10
+        assert hedge_delay('https://node1') == 1.0
+        assert hedge_delay('https://node2') == 0.05
+
+def paged_query(query=None, fields=[], limit=10, offset=0, **kwargs):
+    """
+    A query returning 25 results, in pages of at most 10 documents
+    """
+    return {
+            'responseHeader': {'params': {'rows': limit}},
+            'response': {
+                'numFound': 25,
+                'docs': [{'id': str(i)} for i in range(offset, min(offset+limit, 25))],
+                }
+            }
+
+def test_esgf_docs_paging():
+    """
+    All the pages are retrieved and the documents are returned in order
+    """
+    with mock.patch('clef.esgf.esgf_query', side_effect=paged_query) as query:
+        docs = list(esgf_docs('', 'id', limit=10, project='CMIP6'))
+        assert [d['id'] for d in docs] == [str(i) for i in range(25)]
+        assert sorted(c[1]['offset'] for c in query.call_args_list) == [0, 10, 20]
+        assert all(c[1]['project'] == 'CMIP6' for c in query.call_args_list)
+
+    with mock.patch('clef.esgf.esgf_query', side_effect=empty_query):
+        assert list(esgf_docs('')) == []
+
+    # there are no pages without documents, counting is done by esgf_query
+    with mock.patch('clef.esgf.esgf_query', side_effect=paged_query) as query:
+        with pytest.raises(ESGFException):
+            list(esgf_docs('', 'id', limit=0))
+        with pytest.raises(ESGFException):
+            list(split_docs('', 'id', limit=0))
+        query.assert_not_called()
+
+
+def test_solr_doc_stream():
+    """
+    Documents are decoded correctly whatever the chunk boundaries
+    """
+    response = {
+            'responseHeader': {'status': 0, 'params': {'rows': '3'}},
+            'response': {
+                'numFound': 7,
+                'start': 0,
+                'docs': [{'id': 'a|node', 'title': 'b\u00e9"]'}, {'id': 'c', 'checksum': ['1']}, {'id': 'd'}],
+                },
+            'facet_counts': {},
+            }
+    data = json.dumps(response, indent=1, ensure_ascii=False).encode('utf-8')
+    for size in [1, 2, 7, 64, len(data)]:
+        chunks = [data[i:i+size] for i in range(0, len(data), size)]
+        stream = SolrDocStream(chunks)
+        assert stream.num_found == 7
+        assert stream.rows == 3
+        assert list(stream) == response['response']['docs']
+
+    with pytest.raises(ESGFException):
+        list(SolrDocStream([data[:-40]]))
+
+def test_esgf_docs_stream():
+    """
+    Streamed pages return the same documents as decoded ones
+    """
+    def get(params, stream=False):
+        r = mock.Mock()
+        page = paged_query(limit=params['limit'], offset=params['offset'])
+        r.iter_content.return_value = [json.dumps(page).encode('utf-8')]
+        return r
+
+    with mock.patch('clef.esgf.esgf_get', side_effect=get):
+        docs = list(esgf_docs('', 'id', limit=10, stream=True))
+        assert [d['id'] for d in docs] == [str(i) for i in range(25)]
+
+
+def facet_index_query(query=None, fields=[], limit=10, offset=0, facets=None, **kwargs):
+    """
+    Search a fake index of 60 files with source_id, variable_id and member_id facets
+    """
+    docs = [{'id': f'{m}.{v}.{r}', 'source_id': [m], 'variable_id': [v], 'member_id': [r]}
+            for m in ['m1', 'm2', 'm3'] for v in ['tas', 'pr', 'ua', 'va', 'ta'] for r in ['r1', 'r2', 'r3', 'r4']]
+    for k, v in kwargs.items():
+        if k in ['source_id', 'variable_id', 'member_id']:
+            values = [v] if isinstance(v, str) else v
+            docs = [d for d in docs if d[k][0] in values]
+    response = {
+            'responseHeader': {'params': {'rows': limit}},
+            'response': {'numFound': len(docs), 'docs': docs[offset:offset+limit]},
+            }
+    if facets:
+        response['facet_counts'] = {'facet_fields': {}}
+        for f in facets.split(','):
+            counts = collections.Counter(d[f][0] for d in docs if f in d)
+            response['facet_counts']['facet_fields'][f] = [x for kv in counts.items() for x in kv]
+    return response
+
+def test_split_docs():
+    """
+    Large searches are split along the facets until each fits in a page
+    """
+    with mock.patch('clef.esgf.esgf_query', side_effect=facet_index_query) as query:
+        docs = list(split_docs('', 'id', limit=10, variable_id=('tas', 'pr', 'ua')))
+        assert sorted(d['id'] for d in docs) == sorted(
+                f'{m}.{v}.{r}' for m in ['m1', 'm2', 'm3'] for v in ['tas', 'pr', 'ua'] for r in ['r1', 'r2', 'r3', 'r4'])
+        pages = [c[1] for c in query.call_args_list if c[1]['limit'] > 0]
+        # every search fits in one page
+        assert all(c['offset'] == 0 for c in pages)
+
+        # small searches are not split, the first page has all the results
+        query.reset_mock()
+        docs = list(split_docs('', 'id', limit=10, source_id='m1', variable_id='tas'))
+        assert len(docs) == 4
+        assert query.call_count == 1
+
+        found, counts = facet_counts('', ['source_id'], source_id=('m1', 'm2'))
+        assert found == 40
+        assert counts == {'source_id': {'m1': 20, 'm2': 20}}
+
+
+def partial_facet_query(query=None, fields=[], limit=10, offset=0, facets=None, exclude=True, **kwargs):
+    """
+    Search a fake index of 30 files, 6 of them without source_id and variable_id
+    """
+    docs = [{'id': f'{m}.{v}', 'source_id': [m], 'variable_id': [v]}
+            for m in ['m1', 'm2', 'm3'] for v in ['tas', 'pr', 'ua', 'va', 'ta', 'ts', 'uas', 'vas']]
+    docs += [{'id': f'other{i}'} for i in range(6)]
+    for k, v in kwargs.items():
+        values = [v] if isinstance(v, str) else v
+        if k in ['source_id', 'variable_id']:
+            docs = [d for d in docs if k in d and d[k][0] in values]
+        elif k.endswith('!') and exclude:
+            docs = [d for d in docs if k[:-1] not in d or d[k[:-1]][0] not in values]
+    response = {
+            'responseHeader': {'params': {'rows': limit}},
+            'response': {'numFound': len(docs), 'docs': docs[offset:offset+limit]},
+            }
+    if facets:
+        response['facet_counts'] = {'facet_fields': {}}
+        for f in facets.split(','):
+            counts = collections.Counter(d[f][0] for d in docs if f in d)
+            response['facet_counts']['facet_fields'][f] = [x for kv in counts.items() for x in kv]
+    return response
+
+
+def test_split_docs_partial_facets():
+    """
+    Results without a value for the split facet are searched separately
+    """
+    with mock.patch('clef.esgf.esgf_query', side_effect=partial_facet_query) as query:
+        docs = list(split_docs('', 'id', limit=10))
+        assert len(docs) == 30
+        assert any('source_id!' in c[1] or 'variable_id!' in c[1] for c in query.call_args_list)
+
+    # if the index ignores the exclusion the whole search is paged instead
+    with mock.patch('clef.esgf.esgf_query',
+                    side_effect=lambda *a, **kw: partial_facet_query(*a, exclude=False, **kw)):
+        docs = list(split_docs('', 'id', limit=10))
+        assert len(docs) == 30
+
+
+def dataset_query(query=None, fields=[], limit=10, offset=0, otype='File', **kwargs):
+    """
+    Two datasets, the first with 2 files and the second with 3
+    """
+    facets = {'source_id': ['ACCESS-CM2'], 'experiment_id': ['historical'],
+              'member_id': ['r1i1p1f1'], 'table_id': ['Amon'], 'grid_label': ['gn']}
+    if otype == 'Dataset':
+        docs = [dict(facets, id=f'CMIP6.CMIP.CSIRO-ARCCSS.ACCESS-CM2.historical.r1i1p1f1.Amon.{v}.gn.v20190919|esgf.nci.org.au',
+                     version='20190919', number_of_files=n, variable_id=[v])
+                for v, n in [('tas', 2), ('pr', 3)]]
+    else:
+        docs = [{'id': f'{d}.{v}_{i}.nc|esgf.nci.org.au', 'dataset_id': f'{d}|esgf.nci.org.au',
+                 'checksum': [f'{v}{i}'], 'title': f'{v}_{i}.nc', 'version': '20190919', 'score': 1.0}
+                for d, v, n in [('CMIP6.CMIP.CSIRO-ARCCSS.ACCESS-CM2.historical.r1i1p1f1.Amon.tas.gn.v20190919', 'tas', 2),
+                                ('CMIP6.CMIP.CSIRO-ARCCSS.ACCESS-CM2.historical.r1i1p1f1.Amon.pr.gn.v20190919', 'pr', 3)]
+                for i in range(n)]
+    return {'responseHeader': {'params': {'rows': limit}},
+            'response': {'numFound': len(docs), 'docs': docs[offset:offset+limit]}}
+
+
+def test_match_datasets():
+    """
+    Only the datasets not complete locally are matched file by file
+    """
+    key = ('ACCESS-CM2', 'historical', 'r1i1p1f1', 'Amon')
+    # two partial copies of pr don't make a complete dataset
+    index = {key + ('tas', 'gn', '20190919'): [(2, '/g/data/oi10/tas/'), (2, '/g/data/fs38/tas/')],
+             key + ('pr', 'gn', '20190919'): [(1, '/g/data/oi10/pr/'), (2, '/g/data/fs38/pr/')]}
+    with mock.patch('clef.esgf.esgf_query', side_effect=dataset_query) as query, \
+         mock.patch('clef.esgf.local_dataset_index', return_value=index) as local:
+        paths, pending = match_datasets(None, '', 'CMIP6', latest=True, variable_id=('tas', 'pr'))
+        assert query.call_args[1]['otype'] == 'Dataset'
+        assert local.call_args[0][2]['variable_id'] == {'tas', 'pr'}
+        assert paths == ['/g/data/fs38/tas/']
+        assert pending == ['CMIP6.CMIP.CSIRO-ARCCSS.ACCESS-CM2.historical.r1i1p1f1.Amon.pr.gn.v20190919|esgf.nci.org.au']
+
+        # only the files of the pending datasets are returned
+        query.reset_mock()
+        table, nocksum = find_checksum_id('', datasets=pending, latest=True)
+        assert query.call_args[1]['dataset_id'] == tuple(pending)
+        assert 'otype' not in query.call_args[1]
+
+        # many datasets are requested concurrently in batches, that are not split
+        query.reset_mock()
+        many = pending + [f'd{i}|node' for i in range(60)]
+        with mock.patch('clef.esgf.max_dataset_constraint', 50):
+            table, nocksum = find_checksum_id('', datasets=many, latest=True, split=True)
+        batches = sorted((c[1]['dataset_id'] for c in query.call_args_list), key=len, reverse=True)
+        assert [len(b) for b in batches] == [50, 11]
+        assert sum(batches, ()) == tuple(many)
+        assert not any('facets' in c[1] for c in query.call_args_list)
+
+    # results that cannot be compared are all matched file by file
+    with mock.patch('clef.esgf.esgf_query', side_effect=updated_query), \
+         mock.patch('clef.esgf.local_dataset_index', return_value=index):
+        assert match_datasets(None, '', 'CMIP6', latest=True) == ([], None)
+
+
+def test_match_query_checksum_type():
+    """
+    Each checksum type is joined on its own column, unknown types on both
+    """
+    def typed_query(*args, limit=10, offset=0, **kwargs):
+        docs = [{'id': f'f{i}|node', 'dataset_id': 'd|node', 'checksum': [f'{i}'],
+                 'checksum_type': [t], 'title': f'f{i}.nc', 'version': '1', 'score': 1.0}
+                for i, t in enumerate(['MD5', 'SHA256', 'crc32'])]
+        return {'responseHeader': {'params': {'rows': limit}},
+                'response': {'numFound': len(docs), 'docs': docs[offset:offset+limit]}}
+
+    with mock.patch('clef.esgf.esgf_query', side_effect=typed_query):
+        table, nocksum = find_checksum_id('')
+        assert table.compile().params['checksum_type_values_1'] == ['md5', 'sha256', None]
+
+        subq = match_query(None, '', latest=True)
+        sql = str(subq.compile(dialect=postgresql.dialect()))
+        assert sql.count('UNION ALL') == 2
+        assert 'ON checksums.ch_md5 = esgf_values.checksum LEFT' in sql
+        assert 'ON checksums.ch_sha256 = esgf_values.checksum LEFT' in sql
+        assert 'esgf_paths_path' in subq.c and 'dataset_id' in subq.c
+        # the ESGF arrays are sent and unnested once, also when the matches
+        # are used in another query
+        for q in [subq, sa.select(subq.c.esgf_paths_path).where(subq.c.esgf_paths_file_id == None)]:
+            sql = str(q.compile(dialect=postgresql.dialect()))
+            for c in ['checksum', 'checksum_type', 'id', 'dataset_id', 'title', 'version', 'score']:
+                assert sql.count(f'%({c}_values_1)s') == 1
+            assert sql.count('unnest(') == 1
+
+
 def test_find_cmip6():
     r = esgf_query(query='', fields='id', project='CMIP6', limit=0)
     assert r['response']['numFound'] > 0
@@ -256,3 +607,61 @@ def test_find_cmip6():
 def test_find_cmip5():
     r = esgf_query(query='', fields='id', project='CMIP5', limit=0)
     assert r['response']['numFound'] > 0
+
+def test_solr_doc_stream_close():
+    """
+    The response is closed when the documents are read, or when the iteration stops early
+    """
+    page = json.dumps(paged_query(limit=10, offset=0)).encode('utf-8')
+    response = mock.Mock()
+    stream = SolrDocStream([page], response=response)
+    assert len(list(stream)) == 10
+    response.close.assert_called_once()
+
+    response = mock.Mock()
+    docs = iter(SolrDocStream([page], response=response))
+    next(docs)
+    response.close.assert_not_called()
+    docs.close()
+    response.close.assert_called_once()
+
+    response = mock.Mock()
+    with SolrDocStream([page], response=response):
+        pass
+    response.close.assert_called_once()
+
+    # the pages fetched ahead are closed when the caller stops early
+    responses = []
+    def get(params, stream=False):
+        r = mock.Mock()
+        page = paged_query(limit=params['limit'], offset=params['offset'])
+        r.iter_content.return_value = [json.dumps(page).encode('utf-8')]
+        responses.append(r)
+        return r
+
+    with mock.patch('clef.esgf.esgf_get', side_effect=get):
+        docs = esgf_docs('', 'id', limit=10, stream=True, workers=2)
+        for _ in range(11):
+            next(docs)
+        docs.close()
+    # the last page is only requested if its thread started before close
+    assert len(responses) in (2, 3)
+    assert all(r.close.called for r in responses)
+
+
+def test_local_dataset_index():
+    """
+    Files are counted for each directory, with the same version rule as the local queries
+    """
+    from clef.helpers import version_key_sql
+    from clef.model import ExtendedMetadata, Path
+    session = mock.Mock()
+    q = session.query.return_value.select_from.return_value.join.return_value.outerjoin.return_value
+    q.filter.return_value.filter.return_value.group_by.return_value = [
+            ('m', 'e', 'r', 't', 'v', 'g', '20190919', '/oi10/v/', 1),
+            ('m', 'e', 'r', 't', 'v', 'g', '20190919', '/fs38/v/', 2)]
+    index = local_dataset_index(session, 'CMIP6', {f: set() for f in dataset_facets['CMIP6']})
+    assert index == {('m', 'e', 'r', 't', 'v', 'g', '20190919'): [(1, '/oi10/v/'), (2, '/fs38/v/')]}
+    version = session.query.call_args[0][6]
+    expected = version_key_sql(ExtendedMetadata.version, Path.path)
+    assert str(version.compile(dialect=postgresql.dialect())) == str(expected.compile(dialect=postgresql.dialect()))
@@ -18,7 +18,9 @@ import pytest
 
 from clef.exception import ClefException
 from clef.helpers import check_values, load_vocabularies, check_keys, get_version, get_member, time_axis, \
-                         get_keys, fix_model, fix_path, get_range, convert_periods, get_facets, get_id, get_ids
+                         get_keys, fix_model, fix_path, get_range, convert_periods, get_facets, get_id, get_ids, \
+                         period_stats, fix_dirs, fix_path_sql, version_digits, version_key_sql
+from psycopg2.extras import NumericRange
 from code_fixtures import c5_kwargs, c5_vocab, c5_keys, nranges, periods, empty, dids6, dids5, \
                           results5, results6, remote_results
 
@@ -88,6 +90,28 @@ def test_get_range(periods, empty):
     assert get_range(periods[0]) == ('20060101', '21001231')
     assert get_range(empty) == (None, None)
 
+def test_period_stats(nranges, periods, empty):
+    daily = [NumericRange(20050201, 20050229), NumericRange(20050101, 20050132)]
+    gap = nranges[0:2]
+    odd = [NumericRange(1990, 2000)]
+    datasets = [nranges, daily, gap, empty, [None], odd]
+    res = period_stats(datasets)
+    for i, ranges in enumerate(datasets):
+        p = convert_periods(ranges)
+        f, t = get_range(p)
+        assert [x[i] for x in res] == [p, f, t, time_axis(p, f, t)]
+    assert res[0][0] == periods[0]
+    assert res[3] == [True, True, False, None, None, None]
+
+    # leap days, as with convert_periods and time_axis
+    feb = [NumericRange(200001, 200003), NumericRange(200003, 200004)]
+    daily = [NumericRange(20000101, 20000229), NumericRange(20000301, 20000302)]
+    leap = [NumericRange(19000101, 19000229), NumericRange(19000301, 19000302)]
+    res = period_stats([feb, daily, leap])
+    assert res[0][0][0][1] == '20000229'
+    assert res[3] == [True, False, True]
+
+
 def test_fix_path():
     dir1 = '/g/data/rr3/publications/CMIP5/output1/CSIRO-BOM/more/files/tas_20120115/'
     dir2 = '/g/data/rr3/publications/CMIP5/output1/CSIRO-QCCCE/more/files/tas_20110518/'
@@ -117,6 +141,35 @@ def test_fix_path():
     assert fix_path(dir6, latest) == '/g/data/fs38/publications/CMIP6/CMIP/CSIRO/ACCESS-ESM1-5/historical/r1i1p1f1/day/tasmin/gn/v20191115/'
     assert fix_path(dir6+fname, latest) == '/g/data/fs38/publications/CMIP6/CMIP/CSIRO/ACCESS-ESM1-5/historical/r1i1p1f1/day/tasmin/gn/v20191115/'
     assert fix_path(dir7, latest) == '/path/todelete/'
+    # every 'd' of the version directory is replaced
+    fs38 = '/g/data/fs38/publications/CMIP6/CMIP/CSIRO/ACCESS-ESM1-5/historical/r1i1p1f1/day/tasmin/gn/'
+    assert fix_path(fs38 + 'files/d2019dd/', latest) == fs38 + 'v2019vv/'
+    assert fix_path(fs38 + 'files/d20d1/' + fname, latest) == fs38 + 'v20v1/'
+
+
+def test_fix_dirs():
+    dir1 = '/g/data/al33/replicas/CMIP5/output1/more/v20120316/tas/'
+    dir2 = dir1.replace('output1', 'output2')
+    dir3 = '/g/data/rr3/publications/CMIP5/output1/CSIRO-BOM/more/files/pr_20141119/'
+    fixed = '/g/data/al33/replicas/CMIP5/combined/more/v20120316/tas/'
+    assert fix_dirs([dir1, dir2, dir1, dir3], True) == [fixed, fixed, fixed,
+            '/g/data/rr3/publications/CMIP5/output1/CSIRO-BOM/more/latest/pr/']
+    assert fix_dirs([dir3], False) == [dir3]
+
+
+def test_fix_path_sql():
+    import sqlalchemy as sa
+    from sqlalchemy.dialects import postgresql
+    path = sa.column('path', sa.String)
+    # rules for the latest versions only are left out of all-versions searches
+    latest = fix_path_sql(path, True).compile(dialect=postgresql.dialect())
+    every = fix_path_sql(path, False).compile(dialect=postgresql.dialect())
+    assert str(latest).startswith('CASE WHEN')
+    assert str(latest).count('regexp_replace(') == 8
+    assert str(every).count('regexp_replace(') == 5
+    assert 'path ~' in str(latest)
+    assert r'\1/latest/\2/\3' in latest.params.values()
+    assert 'translate(regexp_replace(path' in str(latest)
 
 
 def test_get_version():
@@ -149,3 +202,13 @@ def test_get_ids(results6, dids6, remote_results):
     assert ids[:] == dids6[:]
     ids =  get_ids(remote_results)
     assert 'mod1.exp1.Amon.r1i1p1f1.tas.v1' in ids
+
+
+def test_version_key_sql():
+    # the SQL version key follows get_version and version_digits
+    from sqlalchemy.dialects import postgresql
+    from clef.model import ExtendedMetadata, Path
+    sql = str(version_key_sql(ExtendedMetadata.version, Path.path).compile(dialect=postgresql.dialect()))
+    assert 'regexp_replace(extended_metadata.version' in sql
+    assert 'SUBSTRING(esgf_paths.path' in sql
+    assert get_version('/a/v20190919/tas.nc') == 'v' + version_digits('v20190919')
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# Copyright 2023 ARC Centre of Excellence for Climate Extremes
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlalchemy as sa
+from sqlalchemy import String, Integer
+from sqlalchemy.sql import column
+from sqlalchemy.dialects import postgresql
+
+from clef.pgvalues import array_values
+
+
+def compile_table(rows):
+    table = array_values([column('checksum', String), column('version', Integer)],
+                         rows, name='esgf_table')
+    return sa.select(table.c.checksum).compile(dialect=postgresql.dialect())
+
+
+def test_array_values():
+    """
+    Rows are sent as one array parameter per column
+    """
+    small = compile_table([('abc', 1), ('def', 2)])
+    assert 'unnest' in str(small)
+    assert 'WITH ORDINALITY AS esgf_table(checksum, version, ordinality)' in str(small)
+    assert list(small.params.values()) == [['abc', 'def'], [1, 2]]
+
+    # the statement doesn't grow with the number of rows
+    large = compile_table([(str(i), i) for i in range(10000)])
+    assert str(large) == str(small)
+
+    empty = compile_table([])
+    assert list(empty.params.values()) == [[], []]
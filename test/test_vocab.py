@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Copyright 2023 ARC Centre of Excellence for Climate Extremes
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pickle
+import pytest
+import click
+from unittest import mock
+
+from clef import vocab
+from clef.helpers import VocabChoice, VocabValues, load_vocabularies
+from clef.exception import ClefException
+
+
+def test_load_store(tmp_path):
+    path = str(tmp_path / 'vocab.pickle')
+    with mock.patch('clef.vocab.store_path', return_value=path):
+        # no compiled file, read the json files
+        with mock.patch('clef.vocab.pickle.load') as load:
+            store = vocab._load_store()
+            load.assert_not_called()
+        assert store == vocab.compile_store()
+        vocab.write_store()
+        with open(path, 'rb') as f:
+            assert pickle.load(f) == store
+        assert vocab._load_store() == store
+        # compiled file older than the json files
+        os.utime(path, (0, 0))
+        with mock.patch('clef.vocab.pickle.load') as load:
+            vocab._load_store()
+            load.assert_not_called()
+
+
+def test_lookups():
+    assert vocab.vocabulary('CMIP5')['realm'] == tuple(load_vocabularies('cmip5')['realm'])
+    assert 'Amon' in vocab.value_sets('CMIP6')['table_id']
+    assert vocab.key_aliases('CMIP5')['v'] == 'variable'
+    assert vocab.key_aliases('CORDEX')['m'] == 'rcm_name'
+    assert 'source_type' not in vocab.valid_keys('CMIP5')
+    assert vocab.facet_names('CORDEX-Adjust')['d'] == 'domain'
+    assert vocab.model_fix('CMIP5')['CESM1-BGC'] == 'CESM1(BGC)'
+    assert vocab.model_fix('CMIP6') == {}
+    with pytest.raises(ClefException):
+        vocab.vocabulary('dummy')
+    # the cached store can't be changed through the lookups
+    with pytest.raises(TypeError):
+        vocab.valid_keys('CMIP5')['dummy'] = ('dummy',)
+    with pytest.raises(TypeError):
+        vocab.model_fix('CMIP5', invert=True)['dummy'] = 'dummy'
+    vocabularies = load_vocabularies('CMIP5')
+    assert isinstance(vocabularies['realm'], list)
+    vocabularies['realm'].append('dummy')
+    assert 'dummy' not in vocab.vocabulary('CMIP5')['realm']
+
+
+def test_vocab_choice():
+    choice = VocabChoice('CMIP5', 'realm')
+    assert tuple(choice.choices) == vocab.vocabulary('CMIP5')['realm']
+    values = VocabValues('CMIP5', 'realm', extra=['dummy'])
+    assert 'atmos' in values and 'dummy' in values and 'ocean2' not in values
+    assert list(values)[-1] == 'dummy' and len(values) == len(vocab.vocabulary('CMIP5')['realm']) + 1
+    assert choice.convert('atmos', None, None) == 'atmos'
+    with pytest.raises(click.BadParameter):
+        choice.convert('dummy', None, None)
+    choice = VocabChoice('CORDEX', 'rcm_name', extra=['CCAM-1391M'], case_sensitive=False)
+    assert choice.convert('ccam-1391m', None, None) == 'CCAM-1391M'